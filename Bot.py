@@ -1,68 +1,45 @@
+from startup import startup_timer, LazyModule # Imported first so boot timing starts as early as possible
+import asyncio
+import hmac
+import html
 import logging
 import os
 import re
+import shutil
+import tempfile
+import threading
 import time
+from collections import deque
 from datetime import datetime, timedelta
-from telegram import Update, ForceReply, ChatMember
-from telegram.ext import (
-    Application, CommandHandler, MessageHandler, filters, ContextTypes
-)
-# Make sure you are using googletrans==4.0.0-rc1 in your requirements.txt
-from googletrans import Translator 
-import yt_dlp
-from flask import Flask, request # Make sure 'Flask' is in your requirements.txt
+with startup_timer.step("import telegram"):
+    from telegram import Update, ForceReply, ChatMember, ChatPermissions
+    from telegram.ext import (
+        Application, CommandHandler, MessageHandler, filters, ContextTypes
+    )
 from threading import Thread # Required for running Flask in a separate thread
+from supervisor import BotSupervisor
+from background import BackgroundJobs
+import database
+import db_maintenance
+import moderation
+import stats_export
+from user_cache import UserCache
+from translation import TranslationPipeline, split_text
+from downloader import (
+    ChatThrottle, DownloadBudget, FileIdCache, MediaItem, ProgressReporter,
+    media_key, media_kind, send_media_items
+)
+from command_router import (
+    CommandRouter, ADMIN, OWNER, NEEDS_TARGET, NEEDS_TARGET_DB, NEEDS_SETTINGS
+)
+from welcome_template import compile_template, TemplateError, DEFAULT_TEMPLATE
 
-# --- Database Setup ---
-from sqlalchemy import create_engine, Column, Integer, String, BigInteger, DateTime, Text, Boolean
-from sqlalchemy.orm import sessionmaker, declarative_base
-
-# Create a SQLite database engine. 'digitalbot.db' file will be created.
-engine = create_engine('sqlite:///digitalbot.db')
-Base = declarative_base() # Base class for our models
-Session = sessionmaker(bind=engine) # Session factory
-
-# Define models (database tables)
-class User(Base):
-    __tablename__ = 'users'
-    id = Column(BigInteger, primary_key=True) # Telegram User ID
-    username = Column(String, nullable=True)
-    first_name = Column(String, nullable=False)
-    last_name = Column(String, nullable=True)
-    
-    total_messages = Column(Integer, default=0)
-    daily_messages = Column(Integer, default=0)
-    hourly_messages = Column(Integer, default=0)
-    weekly_messages = Column(Integer, default=0)
-    monthly_messages = Column(Integer, default=0)
-    last_message_time = Column(DateTime, default=datetime.min)
-    
-    warnings = Column(Integer, default=0)
-    is_special = Column(Boolean, default=False) # Special user
-    
-    def __repr__(self):
-        return f"<User(id={self.id}, username='{self.username}', total_messages={self.total_messages})>"
-
-class ChatSettings(Base):
-    __tablename__ = 'chat_settings'
-    chat_id = Column(BigInteger, primary_key=True)
-    welcome_text = Column(Text, default="خوش آمدید به گروه {group_name}!")
-    welcome_media_id = Column(String, nullable=True)
-    welcome_media_type = Column(String, nullable=True) # 'photo', 'video'
-    warning_limit = Column(Integer, default=5)
-    
-    def __repr__(self):
-        return f"<ChatSettings(chat_id={self.chat_id})>"
-
-class BotOwner(Base):
-    __tablename__ = 'bot_owner'
-    user_id = Column(BigInteger, primary_key=True) # Bot owner's User ID
-    
-    def __repr__(self):
-        return f"<BotOwner(user_id={self.user_id})>"
-
-# Create all tables in the database (if they don't exist)
-Base.metadata.create_all(engine)
+# Heavy modules are imported on first use so a cold start reaches polling quickly.
+# Make sure you are using googletrans==4.0.0-rc1 in your requirements.txt
+googletrans = LazyModule("googletrans")
+yt_dlp = LazyModule("yt_dlp")
+models = LazyModule("models") # SQLAlchemy engine and ORM models
+analytics = LazyModule("analytics") # NumPy
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -74,49 +51,123 @@ logger = logging.getLogger(__name__)
 # It's highly recommended to load this from an environment variable
 TOKEN = os.environ.get("TOKEN", "YOUR_BOT_TOKEN_HERE")
 
+# Warnings stop counting this long after a user's latest warning in a chat
+WARNING_EXPIRY_SECONDS = int(os.environ.get("WARNING_EXPIRY_DAYS", 30)) * 24 * 60 * 60
+
+# Per-day activity is kept this long, then rolled into weekly totals; weekly totals are rolled into monthly ones
+DAILY_ACTIVITY_RETENTION_DAYS = int(os.environ.get("DAILY_ACTIVITY_RETENTION_DAYS", 90))
+WEEKLY_ACTIVITY_RETENTION_DAYS = int(os.environ.get("WEEKLY_ACTIVITY_RETENTION_DAYS", 365))
+
 # --- Flask App for Render Health Check ---
 # This new section solves the 'Port scan timeout' issue.
 # Render needs a web server to confirm the service is alive.
-app = Flask(__name__)
+#
+# /debug/profile and /debug/tasks help find stalls in production. They are disabled unless
+# PROFILER_TOKEN is set, and every request must pass it in an X-Profiler-Token or "Authorization: Bearer"
+# header (never in the URL, which ends up in access logs).
+# /metrics (database sizes, row counts and maintenance timings for Prometheus) works the same way
+# with METRICS_TOKEN, sent as an "Authorization: Bearer" header.
+PROFILER_TOKEN = os.environ.get("PROFILER_TOKEN")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+MAX_PROFILE_SECONDS = 60
+
+bot_loop = None # The bot's event loop, recorded in on_startup so the debug routes can inspect it
+
+def create_flask_app():
+    """Builds the health check app. Flask is imported here, in the server thread, to keep it off the boot path."""
+    from flask import Flask, request, abort # Make sure 'Flask' is in your requirements.txt
+    import profiler
+
+    app = Flask(__name__)
+
+    @app.route('/')
+    def home():
+        return "Bot is running!", 200 # Message for Render that the service is alive
+
+    def require_token(expected, token):
+        if not expected or not hmac.compare_digest((token or "").encode(), expected.encode()):
+            abort(404) # Don't reveal that the route exists
+
+    def bearer_token():
+        authorization = request.headers.get('Authorization', "")
+        return authorization[len("Bearer "):] if authorization.startswith("Bearer ") else None
+
+    def require_profiler_token():
+        require_token(PROFILER_TOKEN, request.headers.get('X-Profiler-Token') or bearer_token())
+
+    @app.route('/metrics')
+    def metrics():
+        """Prometheus text format; table stats are refreshed by the db_maintenance background job."""
+        require_token(METRICS_TOKEN, bearer_token())
+        return db_maintenance.metrics.to_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    @app.route('/debug/profile')
+    def debug_profile():
+        """Samples all threads for ?seconds=N (default 10) and returns collapsed stacks for a flamegraph."""
+        require_profiler_token()
+        seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), MAX_PROFILE_SECONDS)
+        try:
+            stacks = profiler.sample_stacks(seconds)
+        except RuntimeError as e:
+            return f"{e}\n", 409, {'Content-Type': 'text/plain; charset=utf-8'}
+        return profiler.format_collapsed(stacks), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+    @app.route('/debug/tasks')
+    def debug_tasks():
+        """Lists the asyncio tasks pending on the bot's event loop (running handlers, downloads, jobs)."""
+        require_profiler_token()
+        return profiler.dump_asyncio_tasks(bot_loop), 200, {'Content-Type': 'text/plain; charset=utf-8'}
 
-@app.route('/')
-def home():
-    return "Bot is running!", 200 # Message for Render that the service is alive
+    return app
 
 # --- Helper Functions for Database Interaction ---
 
+_schema_ready = False
+
+def ensure_schema():
+    """Loads the ORM and checks the schema version, once per process."""
+    global _schema_ready
+    if not _schema_ready:
+        with startup_timer.step("schema check"):
+            models.init_schema()
+        _schema_ready = True
+
+def Session():
+    """Opens a database session. The ORM is loaded and the schema checked on first use."""
+    ensure_schema()
+    return models.Session()
+
 def get_chat_settings_db(session, chat_id):
     """Retrieves or creates chat settings from the database."""
-    settings = session.query(ChatSettings).filter_by(chat_id=chat_id).first()
+    settings = session.query(models.ChatSettings).filter_by(chat_id=chat_id).first()
     if not settings:
-        settings = ChatSettings(chat_id=chat_id)
+        settings = models.ChatSettings(chat_id=chat_id)
         session.add(settings)
         session.commit()
     return settings
 
-def get_or_create_user_db(session, user_id, username, first_name, last_name):
-    """Retrieves or creates a user from the database."""
-    user = session.query(User).filter_by(id=user_id).first()
-    if not user:
-        user = User(
-            id=user_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name
-        )
-        session.add(user)
-        session.commit()
-    return user
+# Compact user records served from memory; changes are written back in batches by flush_user_cache
+user_cache = UserCache(capacity=int(os.environ.get("USER_CACHE_SIZE", 10000)))
+
+def get_cached_user(telegram_user):
+    """Returns the cached record for a Telegram user, creating the users row if needed."""
+    ensure_schema()
+    return user_cache.get_or_create(
+        telegram_user.id,
+        telegram_user.username,
+        telegram_user.first_name,
+        telegram_user.last_name
+    )
 
 def get_bot_owner_id_db(session):
     """Retrieves the bot owner's ID from the database."""
-    owner = session.query(BotOwner).first()
+    owner = session.query(models.BotOwner).first()
     return owner.user_id if owner else None
 
 def set_bot_owner_id_db(session, user_id):
     """Sets the bot owner's ID in the database."""
-    session.query(BotOwner).delete() # Remove previous owner if exists
-    owner = BotOwner(user_id=user_id)
+    session.query(models.BotOwner).delete() # Remove previous owner if exists
+    owner = models.BotOwner(user_id=user_id)
     session.add(owner)
     session.commit()
 
@@ -205,9 +256,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 - **اخطار دادن:** روی پیامی از کاربر ریپلای کن و بنویس 'اخطار'. (پیش‌فرض 5 اخطار تا بن)
 - **تنظیم حد اخطار:** روی پیامی ریپلای کن و بنویس 'تنظیم اخطار <عدد>'.
 - **سکوت کاربر:** روی پیامی از کاربر ریپلای کن و بنویس 'سکوت <عدد به دقیقه>'.
+- **بن/رفع بن/سکوت گروهی:** روی پیامی حاوی آیدی‌های عددی ریپلای کن و بنویس 'بن گروهی'، 'رفع بن گروهی' یا 'سکوت گروهی <عدد به دقیقه>'.
+    با 'بن گروهی اخیر 30' همه کسانی که در 30 دقیقه اخیر عضو شده‌اند بن می‌شوند. اگر بخشی از عملیات ناموفق بود، با 'ادامه عملیات <شماره>' دوباره امتحان کن.
 - **ادمین کردن کاربر:** روی پیامی از کاربر ریپلای کن و بنویس 'ادمین'.
+- **آمار فعالیت گروه:** دستور /analytics (اعضای فعال و غیرفعال، نقشه فعالیت ساعتی و ماندگاری اعضای جدید).
+- **خروجی آمار:** دستور /export (یا /export jsonl) فایل فشرده آمار اعضا و تاریخچه فعالیت را می‌فرستد.
 - **تنظیم پیام خوشامدگویی:**
     - برای تنظیم متن: روی پیامی ریپلای کن و بنویس 'تنظیم خوشامد متن'.
+      متغیرهای قابل استفاده: {{user_name}}، {{group_name}}، {{member_count}}، {{join_time}}
     - برای تنظیم تصویر/ویدیو: روی تصویر/ویدیوی مورد نظر ریپلای کن و بنویس 'تنظیم خوشامد رسانه'.
 
 **قابلیت‌های مالک گروه (فقط برای سازنده گروه یا مالک ربات):**
@@ -215,6 +271,51 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 - **مالک ربات:** روی پیامی از کاربر ریپلای کن و بنویس 'مالک ربات'. (کاربر قابلیت‌های مالک گروه رو می‌گیره)
 """)
 
+# --- Translation ---
+
+_translator_local = threading.local() # One googletrans Translator (and HTTP client) per worker thread
+
+def _google_translate(text, dest):
+    """Blocking googletrans call; the translation pipeline runs it in worker threads."""
+    translator = getattr(_translator_local, 'translator', None)
+    if translator is None:
+        translator = _translator_local.translator = googletrans.Translator()
+    return translator.translate(text, dest=dest).text
+
+# Splits long texts, translates the pieces concurrently and batches bursts of requests into fewer calls
+translation_pipeline = TranslationPipeline(_google_translate, max_concurrency=int(os.environ.get("TRANSLATE_CONCURRENCY", 4)))
+
+# Telegram rejects messages longer than 4096 characters
+MAX_MESSAGE_CHARS = 4000
+
+def pack_message_chunks(text, max_chars=MAX_MESSAGE_CHARS):
+    """
+    Splits `text` into as few messages as possible: whole lines are packed together up to
+    `max_chars`, and only lines that are too long on their own are broken up.
+    """
+    if len(text) <= max_chars:
+        return [text]
+    messages = []
+    current = None
+    for line in text.split("\n"):
+        pieces = [chunk for chunk, _ in split_text(line, max_chars) if chunk] if len(line) > max_chars else [line]
+        for piece in pieces:
+            if current is None:
+                current = piece
+            elif len(current) + 1 + len(piece) <= max_chars:
+                current = f"{current}\n{piece}"
+            else:
+                messages.append(current)
+                current = piece
+    if current:
+        messages.append(current)
+    return messages
+
+async def reply_long_text(message, text, **kwargs):
+    """Replies with `text` in one message, or in several only if it's too long for one."""
+    for chunk in pack_message_chunks(text):
+        await message.reply_text(chunk, **kwargs)
+
 async def translate_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Translates text to Farsi."""
     if not context.args:
@@ -222,78 +323,159 @@ async def translate_text(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     text_to_translate = " ".join(context.args)
-    translator = Translator()
     try:
-        translated = translator.translate(text_to_translate, dest='fa')
-        await update.message.reply_text(f"ترجمه: {translated.text}")
+        translated = await translation_pipeline.translate(text_to_translate, dest='fa')
+        await reply_long_text(update.message, f"ترجمه: {translated}")
     except Exception as e:
         logger.error(f"Translation error: {e}")
         await update.message.reply_text("متاسفانه در حال حاضر امکان ترجمه وجود نداره. لطفاً بعداً امتحان کنید.")
-        # --- Download Handler & Link Management ---
+
+# --- Download Handler & Link Management ---
+
+MAX_DOWNLOAD_FILE_BYTES = 50 * 1024 * 1024 # 50 MB limit for easy upload to Telegram
+MAX_ALBUM_ITEMS = int(os.environ.get("MAX_ALBUM_ITEMS", 20)) # Items fetched from one carousel/album post
+ESTIMATED_ITEM_BYTES = 8 * 1024 * 1024 # Reserved per item when yt-dlp doesn't know the size in advance
+
+# Shared by every download job: fetches running at once and bytes of downloaded files on disk
+download_budget = DownloadBudget(
+    max_concurrency=int(os.environ.get("DOWNLOAD_CONCURRENCY", 3)),
+    max_bytes=int(os.environ.get("DOWNLOAD_BUDGET_MB", 200)) * 1024 * 1024
+)
+media_file_ids = FileIdCache() # Items sent before are re-sent by file_id instead of downloaded again
+# Status messages are edited at most once per this many seconds in each chat (Telegram limits edits in groups)
+progress_throttle = ChatThrottle(float(os.environ.get("PROGRESS_EDIT_INTERVAL", 3)))
+
+DOWNLOAD_CAPTIONS = {
+    'video': "ویدیوی شما آماده است!",
+    'photo': "تصویر شما آماده است!",
+    'audio': "فایل صوتی شما آماده است!",
+    'document': "فایل شما آماده است!",
+}
+
+def _probe_url(ydl_opts, url):
+    """Resolves the link without downloading; carousels come back with one entry per item."""
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.extract_info(url, download=False)
+
+def _download_entry(ydl_opts, entry):
+    """Downloads one resolved entry in a worker thread (YoutubeDL instances aren't thread-safe) and returns its path."""
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.process_ie_result(entry, download=True)
+        downloads = info.get('requested_downloads') or [{}]
+        return downloads[0].get('filepath') or ydl.prepare_filename(info)
+
+def _estimated_size(entry):
+    size = entry.get('filesize') or entry.get('filesize_approx') or ESTIMATED_ITEM_BYTES
+    return min(size, MAX_DOWNLOAD_FILE_BYTES)
+
+async def _fetch_item(ydl_opts, entry, item, reporter, index):
+    ydl_opts = dict(ydl_opts, progress_hooks=[reporter.hook(index)])
+    async with download_budget.slot(job=reporter, on_queue=reporter.set_queue_position):
+        path = await asyncio.to_thread(_download_entry, ydl_opts, entry)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    item.path = path
+    item.kind = media_kind(os.path.splitext(path)[1].lstrip('.')) # The final container can differ from the probe
+
+async def _report_download_failure(update, reporter, text):
+    if reporter is not None:
+        await reporter.fail(text) # Reuse the status message
+    else:
+        await update.message.reply_text(text)
 
 async def _perform_download(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str) -> None:
-    """Helper function to perform the actual download using yt-dlp."""
+    """
+    Helper function to perform the actual download using yt-dlp. Posts with several items
+    (Instagram carousels, multi-image pins) are fetched concurrently and sent as albums.
+    """
     instagram_cookies = os.environ.get("INSTAGRAM_COOKIES") # Get cookies from environment variable
-        
+    reporter = None # Edits one status message with the job's progress; errors are shown in it too
+
+    os.makedirs('downloads', exist_ok=True) # Ensure 'downloads' directory exists
+    job_dir = tempfile.mkdtemp(prefix='job_', dir='downloads') # Concurrent jobs (and album items) never share files
     # Path for temporary cookies file
-    cookies_file_path = 'cookies.txt' 
+    cookies_file_path = os.path.join(job_dir, 'cookies.txt')
 
     try:
         ydl_opts = {
             'format': 'best',
-            'outtmpl': 'downloads/%(title)s.%(ext)s',
-            'noplaylist': True,
-            'max_filesize': 50 * 1024 * 1024, # 50 MB limit for easy upload to Telegram
+            'outtmpl': os.path.join(job_dir, '%(id)s.%(ext)s'),
+            'noplaylist': True, # A video inside a playlist link is downloaded alone; carousels still list their items
+            'playlistend': MAX_ALBUM_ITEMS,
+            'max_filesize': MAX_DOWNLOAD_FILE_BYTES,
             'nocheckcertificate': True,
             'retries': 3,
             'no_warnings': True,
             'quiet': True,
-            # Add cookies if available
-            'cookiefile': cookies_file_path, # yt-dlp reads cookies from this file
         }
-        
+
         # If cookies are received from environment variable, save them to a temporary file
         if instagram_cookies:
             with open(cookies_file_path, 'w') as f:
                 f.write(instagram_cookies)
+            ydl_opts['cookiefile'] = cookies_file_path # yt-dlp reads cookies from this file
             logger.info("Instagram cookies loaded from environment variable.")
         else:
             logger.warning("INSTAGRAM_COOKIES environment variable not set. Instagram downloads might fail.")
 
-        os.makedirs('downloads', exist_ok=True) # Ensure 'downloads' directory exists
+        status_message = await update.message.reply_text("در حال پردازش و دانلود لینک شما، لطفاً منتظر بمانید...")
+        reporter = ProgressReporter(status_message, progress_throttle)
 
-        await update.message.reply_text("در حال پردازش و دانلود لینک شما، لطفاً منتظر بمانید...")
+        info = await asyncio.to_thread(_probe_url, ydl_opts, url)
+        is_album = 'entries' in info
+        entries = [entry for entry in info.get('entries') or [] if entry] if is_album else [info]
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
+        items = []
+        to_fetch = []
+        for entry in entries:
+            key = media_key(entry)
+            cached = media_file_ids.get(key)
+            if cached is not None:
+                items.append(MediaItem(key, cached[0], file_id=cached[1]))
+            else:
+                item = MediaItem(key, media_kind(entry.get('ext')))
+                items.append(item)
+                to_fetch.append((entry, item))
+
+        reporter.item_count = max(len(to_fetch), 1)
+        reserve = sum(_estimated_size(entry) for entry, _ in to_fetch)
+        async with download_budget.reserve(reserve, job=reporter, on_queue=reporter.set_queue_position):
+            results = await asyncio.gather(
+                *(_fetch_item(ydl_opts, entry, item, reporter, index) for index, (entry, item) in enumerate(to_fetch)),
+                return_exceptions=True
+            )
+            errors = [result for result in results if isinstance(result, BaseException)]
+            for error in errors:
+                logger.error(f"Download error for an item of {url}: {error}")
+
+            ready = [item for item in items if item.file_id or item.path]
+            if not ready:
+                if errors and isinstance(errors[0], yt_dlp.DownloadError):
+                    raise errors[0]
+                await reporter.fail("متاسفانه در دانلود محتوا مشکلی پیش آمد.")
+                return
 
-        if os.path.exists(filename):
-            if info.get('ext') in ['mp4', 'webm', 'avi', 'mkv', 'mov']:
-                await update.message.reply_video(video=open(filename, 'rb'), caption="ویدیوی شما آماده است!")
-            elif info.get('ext') in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
-                await update.message.reply_photo(photo=open(filename, 'rb'), caption="تصویر شما آماده است!")
-            elif info.get('ext') in ['mp3', 'wav', 'ogg', 'flac']:
-                await update.message.reply_audio(audio=open(filename, 'rb'), caption="فایل صوتی شما آماده است!")
+            if is_album:
+                caption = "آلبوم شما آماده است!"
+                if errors:
+                    caption += f" ({len(errors)} مورد دانلود نشد)"
             else:
-                await update.message.reply_document(document=open(filename, 'rb'), caption="فایل شما آماده است!")
-            
-            os.remove(filename)  # Delete file after sending
-            if os.path.exists('downloads') and not os.listdir('downloads'): # Check if dir is empty before removing
-                os.rmdir('downloads')
-        else:
-            await update.message.reply_text("متاسفانه در دانلود محتوا مشکلی پیش آمد.")
+                caption = DOWNLOAD_CAPTIONS[ready[0].kind]
+            reporter.set_uploading()
+            await send_media_items(update.message, ready, caption, media_file_ids)
+            await reporter.finish()
 
     except yt_dlp.DownloadError as e:
         logger.error(f"Download error with yt-dlp for {url}: {e}")
-        await update.message.reply_text(f"متاسفانه در دانلود محتوا مشکلی پیش آمد. دلیل احتمالی: {e.msg}")
+        await _report_download_failure(update, reporter, f"متاسفانه در دانلود محتوا مشکلی پیش آمد. دلیل احتمالی: {e.msg}")
     except Exception as e:
         logger.error(f"General download error for {url}: {e}")
-        await update.message.reply_text("یک خطای ناشناخته در هنگام دانلود رخ داد. لطفاً مطمئن شوید لینک معتبر است.")
+        await _report_download_failure(update, reporter, "یک خطای ناشناخته در هنگام دانلود رخ داد. لطفاً مطمئن شوید لینک معتبر است.")
     finally:
-        # Clean up the temporary cookies file after completion (important for security and cleanup)
-        if os.path.exists(cookies_file_path):
-            os.remove(cookies_file_path)
+        if reporter is not None:
+            reporter.close()
+        # Delete the downloaded files and the temporary cookies file (important for security and cleanup)
+        shutil.rmtree(job_dir, ignore_errors=True)
 
 async def download_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the /download command for private chats or explicit command usage."""
@@ -311,16 +493,9 @@ async def manage_group_links(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if update.effective_chat.type not in ["group", "supergroup"]:
         return # Only for groups
 
-    session = Session()
+    session = None # Only opened when the chat settings are needed
     try:
-        user_id = update.effective_user.id
-        user = get_or_create_user_db(
-            session,
-            user_id,
-            update.effective_user.username,
-            update.effective_user.first_name,
-            update.effective_user.last_name
-        )
+        user = get_cached_user(update.effective_user)
 
         message_text = update.message.text
         urls = re.findall(r'https?://[^\s]+', message_text)
@@ -351,14 +526,12 @@ async def manage_group_links(update: Update, context: ContextTypes.DEFAULT_TYPE)
             try:
                 # Get chat settings to know the warning limit
                 chat_id = update.effective_chat.id
+                session = Session()
                 settings = get_chat_settings_db(session, chat_id)
 
                 await update.message.delete()
-                # Apply warning to user
-                user.warnings += 1
-                session.commit() # Save changes to DB
-
-                current_warnings = user.warnings
+                # Apply warning to user (counted per chat)
+                current_warnings = database.add_warning(chat_id, user.id, WARNING_EXPIRY_SECONDS)
                 if current_warnings >= settings.warning_limit:
                     try:
                         await context.bot.ban_chat_member(chat_id=chat_id, user_id=user.id)
@@ -367,8 +540,7 @@ async def manage_group_links(update: Update, context: ContextTypes.DEFAULT_TYPE)
                             text=f"{user.first_name} به دلیل ارسال لینک غیرمجاز و رسیدن به {settings.warning_limit} اخطار از گروه بن شد.",
                             parse_mode='HTML'
                         )
-                        user.warnings = 0 # Reset warnings after ban
-                        session.commit()
+                        database.reset_warnings(chat_id, user.id) # Reset warnings after ban
                     except Exception as e:
                         logger.error(f"Error banning user after warnings for link: {e}")
                         await context.bot.send_message(
@@ -388,406 +560,656 @@ async def manage_group_links(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     text="ربات نتوانست پیام حاوی لینک غیرمجاز را حذف کند یا اخطار بدهد. لطفاً مطمئن شوید ربات مجوزهای لازم را دارد."
                 )
     except Exception as e:
-        session.rollback()
+        if session is not None:
+            session.rollback()
         logger.error(f"Error in manage_group_links (outer try): {e}")
     finally:
-        session.close()
+        if session is not None:
+            session.close()
+
+
+# --- Reply Command Router ---
+
+reply_commands = CommandRouter() # Keyword table for every command triggered by replying to a message
+
+class CommandContext:
+    """Per-invocation data for a reply command. Only what the command declared in `needs` is loaded."""
+    __slots__ = ('chat_id', 'args', 'session', 'target_user_id', 'target_user_name', 'target_member', 'target_user_db', 'settings')
+
+    def __init__(self, chat_id, args, session):
+        self.chat_id = chat_id
+        self.args = args
+        self.session = session
+        self.target_user_id = None
+        self.target_user_name = None
+        self.target_member = None # ChatMember, if the router already had to fetch it
+        self.target_user_db = None
+        self.settings = None
+
+def _user_display_name(user):
+    """Builds 'First Last (@username)' for a Telegram user."""
+    name = user.first_name if user.first_name else "کاربر"
+    if user.last_name:
+        name += f" {user.last_name}"
+    if user.username:
+        name += f" (@{user.username})"
+    return name
+
+class ReplyCommandFilter(filters.MessageFilter):
+    """Matches replies whose text is a registered keyword and passes the match on to the handler."""
+
+    def __init__(self, router):
+        super().__init__(name="ReplyCommandFilter", data_filter=True)
+        self.router = router
+
+    def filter(self, message):
+        match = self.router.match(message.text)
+        return {"matches": [match]} if match else False
+
+async def route_reply_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Runs the reply command matched by ReplyCommandFilter after checking permissions and loading its data."""
+    match = context.matches[0]
+    command = match.command
+    reply = update.message.reply_to_message
+
+    session = Session()
+    try:
+        # Check permissions first (is_admin_or_creator / is_group_owner send their own message)
+        if command.role == ADMIN and not await is_admin_or_creator(update, context):
+            return
+        if command.role == OWNER:
+            # The group creator OR the designated bot owner
+            if update.effective_user.id != get_bot_owner_id_db(session) and not await is_group_owner(update, context):
+                return
+
+        cmd = CommandContext(update.effective_chat.id, match.args, session)
+
+        if NEEDS_TARGET in command.needs or NEEDS_TARGET_DB in command.needs:
+            target_user = reply.from_user
+            if command.resolve_target:
+                cmd.target_user_id = await command.resolve_target(update)
+                if cmd.target_user_id is None:
+                    return # The resolver already told the user what was wrong
+                if cmd.target_user_id != target_user.id:
+                    # We need the user's name even if they are not in our DB yet; handlers reuse the member
+                    cmd.target_member = await context.bot.get_chat_member(chat_id=cmd.chat_id, user_id=cmd.target_user_id)
+                    target_user = cmd.target_member.user
+            else:
+                cmd.target_user_id = target_user.id
+            cmd.target_user_name = _user_display_name(target_user)
+
+            if NEEDS_TARGET_DB in command.needs:
+                cmd.target_user_db = get_cached_user(target_user)
 
+        if NEEDS_SETTINGS in command.needs:
+            cmd.settings = get_chat_settings_db(session, cmd.chat_id)
+
+        await command.handler(update, context, cmd)
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error in reply command '{command.keyword}': {e}")
+    finally:
+        session.close()
 
 # --- Reply Translation Handler ---
 
-async def reply_translate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Translates the replied message to Farsi if the reply text is 'ترجمه'."""
-    # Ensure update.message.text is not None and matches "ترجمه" exactly after stripping whitespace
-    if update.message.reply_to_message and update.message.text and update.message.text.strip() == "ترجمه":
-        original_message_text = update.message.reply_to_message.text
-        if not original_message_text:
-            await update.message.reply_text("پیام ریپلای شده متنی برای ترجمه ندارد.")
-            return
+@reply_commands.command("ترجمه")
+async def reply_translate(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Translates the replied message to Farsi when someone replies to it with 'ترجمه'."""
+    original_message_text = update.message.reply_to_message.text
+    if not original_message_text:
+        await update.message.reply_text("پیام ریپلای شده متنی برای ترجمه ندارد.")
+        return
 
-        translator = Translator()
-        try:
-            translated = translator.translate(original_message_text, dest='fa')
-            await update.message.reply_text(f"ترجمه پیام اصلی: {translated.text}", reply_to_message_id=update.message.reply_to_message.message_id)
-        except Exception as e:
-            logger.error(f"Reply translation error: {e}")
-            await update.message.reply_text("متاسفانه در حال حاضر امکان ترجمه وجود نداره. لطفاً بعداً امتحان کنید.")
+    try:
+        translated = await translation_pipeline.translate(original_message_text, dest='fa')
+        await reply_long_text(
+            update.message,
+            f"ترجمه پیام اصلی: {translated}",
+            reply_to_message_id=update.message.reply_to_message.message_id
+        )
+    except Exception as e:
+        logger.error(f"Reply translation error: {e}")
+        await update.message.reply_text("متاسفانه در حال حاضر امکان ترجمه وجود نداره. لطفاً بعداً امتحان کنید.")
 
 # --- Welcome New Members ---
 
-async def greet_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Greets new members joining the group."""
-    session = Session()
+# Joins arriving within this window are greeted with a single combined message.
+WELCOME_BATCH_SECONDS = float(os.environ.get("WELCOME_BATCH_SECONDS", 5))
+# Upper bound on welcome messages sent to one chat per minute (protects against flood limits).
+# Windows over the limit are not greeted at all, so a raid can't queue up a stream of welcomes.
+WELCOME_MAX_PER_MINUTE = int(os.environ.get("WELCOME_MAX_PER_MINUTE", 3))
+# Maximum members mentioned in one welcome message. Anyone beyond that, or beyond what fits
+# in the message, is only counted ("و N نفر دیگر").
+WELCOME_MAX_MENTIONS = 15
+# Telegram's limits on visible text after HTML parsing, counted in UTF-16 code units
+MAX_CAPTION_CHARS = 1024
+MAX_TEXT_CHARS = 4096
+_HTML_TAG = re.compile(r'<[^>]+>')
+
+welcome_settings_cache = {} # chat_id -> (compiled welcome template, welcome_media_id, welcome_media_type)
+pending_joins = {} # chat_id -> [members to mention (at most WELCOME_MAX_MENTIONS), number of other joins]
+welcome_flush_tasks = {} # chat_id -> task that sends the combined welcome
+welcome_sent_times = {} # chat_id -> deque of monotonic timestamps of sent welcomes
+
+def get_welcome_settings_cached(chat_id):
+    """Returns the chat's compiled welcome settings, loading them from the database only once."""
+    cached = welcome_settings_cache.get(chat_id)
+    if cached is None:
+        session = Session()
+        try:
+            settings = get_chat_settings_db(session, chat_id)
+            try:
+                template = compile_template(settings.welcome_text)
+            except TemplateError as e:
+                # Templates saved before validation existed may be malformed
+                logger.warning(f"Invalid welcome template for chat {chat_id}, using default: {e}")
+                template = DEFAULT_TEMPLATE
+            cached = (template, settings.welcome_media_id, settings.welcome_media_type)
+            welcome_settings_cache[chat_id] = cached
+        finally:
+            session.close()
+    return cached
+
+def invalidate_welcome_cache(chat_id):
+    """Drops cached welcome settings after an admin changes them."""
+    welcome_settings_cache.pop(chat_id, None)
+
+def _visible_length(html_text):
+    """Length Telegram checks against its limits: text without tags, in UTF-16 code units."""
+    return len(html.unescape(_HTML_TAG.sub("", html_text)).encode('utf-16-le')) // 2
+
+def _render_welcome(template, values, members, others, max_chars):
+    """Renders the welcome, dropping mentions from the end (and counting them instead) until it fits."""
+    mentions = [member.mention_html() for member in members]
+    while True:
+        user_names = "، ".join(mentions)
+        extra = others + len(members) - len(mentions)
+        if extra:
+            user_names = f"{user_names} و {extra} نفر دیگر" if user_names else f"{extra} نفر"
+        text = template.render(dict(values, user_name=user_names))
+        if not mentions or _visible_length(text) <= max_chars:
+            return text
+        mentions.pop()
+
+async def _send_welcome(bot, chat_id, group_name, members, others=0):
+    """Sends one welcome message mentioning the given members and counting `others` more."""
+    template, media_id, media_type = get_welcome_settings_cached(chat_id)
+
+    values = {
+        'group_name': html.escape(group_name or ""),
+        'join_time': datetime.now().strftime("%H:%M"),
+    }
+    if 'member_count' in template.fields: # Costs an API call, so only fetch it when used
+        values['member_count'] = await bot.get_chat_member_count(chat_id)
+
+    with_media = bool(media_id) and media_type in ('photo', 'video')
+    if with_media:
+        welcome_text_formatted = _render_welcome(template, values, members, others, MAX_CAPTION_CHARS)
+        # Even without mentions the admin's text may be too long for a caption; send it without the media then
+        with_media = _visible_length(welcome_text_formatted) <= MAX_CAPTION_CHARS
+    if not with_media:
+        welcome_text_formatted = _render_welcome(template, values, members, others, MAX_TEXT_CHARS)
+
+    if with_media and media_type == 'photo':
+        await bot.send_photo(chat_id=chat_id, photo=media_id, caption=welcome_text_formatted, parse_mode='HTML')
+    elif with_media and media_type == 'video':
+        await bot.send_video(chat_id=chat_id, video=media_id, caption=welcome_text_formatted, parse_mode='HTML')
+    else:
+        await bot.send_message(chat_id=chat_id, text=welcome_text_formatted, parse_mode='HTML')
+
+async def _flush_welcome(bot, chat_id, group_name):
+    """Waits for the aggregation window to close, then greets everyone who joined in it with one message."""
     try:
-        chat_id = update.effective_chat.id
-        settings = get_chat_settings_db(session, chat_id)
-
-        for member in update.message.new_chat_members:
-            if member.id == context.bot.id: # If the bot itself was added
-                await update.message.reply_text("ممنون که منو به گروهتون اضافه کردید! من DigitalBot هستم و آماده‌ام تا به شما کمک کنم.")
-                continue
-
-            group_name = update.effective_chat.title
-            welcome_text_formatted = settings.welcome_text.format(
-                user_name=member.mention_html(),
-                group_name=group_name
-            )
+        await asyncio.sleep(WELCOME_BATCH_SECONDS)
+        # Close the window before any await, so later joins start a new one
+        welcome_flush_tasks.pop(chat_id, None)
+        members, others = pending_joins.pop(chat_id, ([], 0))
+        if not members:
+            return
 
-            if settings.welcome_media_id and settings.welcome_media_type:
-                if settings.welcome_media_type == 'photo':
-                    await update.message.reply_photo(
-                        photo=settings.welcome_media_id,
-                        caption=welcome_text_formatted,
-                        parse_mode='HTML'
-                    )
-                elif settings.welcome_media_type == 'video':
-                    await update.message.reply_video(
-                        video=settings.welcome_media_id,
-                        caption=welcome_text_formatted,
-                        parse_mode='HTML'
-                    )
-            else:
-                await update.message.reply_html(
-                    f"خوش آمدید {member.mention_html()} به گروه **{group_name}**!",
-                    parse_mode='HTML'
-                )
+        sent_times = welcome_sent_times.setdefault(chat_id, deque())
+        now = time.monotonic()
+        while sent_times and now - sent_times[0] >= 60:
+            sent_times.popleft()
+        if len(sent_times) >= WELCOME_MAX_PER_MINUTE:
+            logger.info(f"Not welcoming {len(members) + others} members in chat {chat_id}: over {WELCOME_MAX_PER_MINUTE} welcomes per minute.")
+            return
+
+        sent_times.append(now)
+        await _send_welcome(bot, chat_id, group_name, members, others)
+    except Exception as e:
+        logger.error(f"Error sending welcome message: {e}")
     finally:
-        session.close()
-        # --- Admin Capabilities ---
+        if welcome_flush_tasks.get(chat_id) is asyncio.current_task():
+            welcome_flush_tasks.pop(chat_id, None) # Cancelled before the window closed
+
+async def greet_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Queues new members for a combined welcome message."""
+    chat_id = update.effective_chat.id
+
+    new_members = []
+    for member in update.message.new_chat_members:
+        if member.id == context.bot.id: # If the bot itself was added
+            await update.message.reply_text("ممنون که منو به گروهتون اضافه کردید! من DigitalBot هستم و آماده‌ام تا به شما کمک کنم.")
+            continue
+        new_members.append(member)
+
+    if not new_members:
+        return
 
-async def admin_actions_on_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles admin actions triggered by replying to a message."""
-    session = Session()
     try:
-        if not update.message.reply_to_message or not update.message.text:
-            return # Not a reply or no text in the message
+        ensure_schema() # Join updates aren't text, so this may be the first database access
+        database.record_joins(chat_id, [member.id for member in new_members]) # For bulk moderation of recent joiners
+    except Exception as e:
+        logger.error(f"Error recording joins: {e}")
+
+    pending = pending_joins.setdefault(chat_id, [[], 0])
+    room = WELCOME_MAX_MENTIONS - len(pending[0])
+    pending[0].extend(new_members[:room])
+    pending[1] += len(new_members[room:]) # Only counted, so a raid doesn't pile up member objects
+    if chat_id not in welcome_flush_tasks:
+        welcome_flush_tasks[chat_id] = context.application.create_task(
+            _flush_welcome(context.bot, chat_id, update.effective_chat.title)
+        )
 
-        # Check admin status first
-        if not await is_admin_or_creator(update, context):
-            return # Only admins can use these commands (is_admin_or_creator sends a message)
+# --- Admin Capabilities ---
 
-        target_user_id = update.message.reply_to_message.from_user.id
-        # If the replied message is just a user ID, use that for target_user_id
-        if update.message.reply_to_message.text and update.message.text.strip() == "رفع بن":
-            try:
-                target_user_id = int(update.message.reply_to_message.text.strip())
-            except ValueError:
-                await update.message.reply_text("برای رفع بن، لطفاً روی پیامی که حاوی آیدی عددی کاربر است ریپلای کنید.")
-                return
-        
-        target_user_info = await context.bot.get_chat_member(chat_id=update.effective_chat.id, user_id=target_user_id)
-        # We need the user's name even if they are not in our DB yet.
-        target_user_name = target_user_info.user.first_name if target_user_info.user.first_name else "کاربر"
-        if target_user_info.user.last_name:
-            target_user_name += f" {target_user_info.user.last_name}"
-        if target_user_info.user.username:
-            target_user_name += f" (@{target_user_info.user.username})"
-
-        # Ensure target_user exists in our DB if we're going to modify it (like warnings)
-        target_user_db = get_or_create_user_db(
-            session,
-            target_user_id,
-            target_user_info.user.username,
-            target_user_info.user.first_name,
-            target_user_info.user.last_name
+async def _target_from_replied_id(update: Update):
+    """For unban: the replied message is expected to contain the numeric user ID."""
+    try:
+        return int(update.message.reply_to_message.text.strip())
+    except (AttributeError, ValueError):
+        await update.message.reply_text("برای رفع بن، لطفاً روی پیامی که حاوی آیدی عددی کاربر است ریپلای کنید.")
+        return None
+
+@reply_commands.command("پین", role=ADMIN)
+async def pin_message(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Pins the replied message."""
+    try:
+        await context.bot.pin_chat_message(
+            chat_id=cmd.chat_id,
+            message_id=update.message.reply_to_message.message_id,
+            disable_notification=False
         )
+        await update.message.reply_text("پیام پین شد.")
+    except Exception as e:
+        logger.error(f"Error pinning message: {e}")
+        await update.message.reply_text("متاسفانه نتوانستم پیام را پین کنم. (شاید ربات مجوز ندارد)")
 
-        chat_id = update.effective_chat.id
-        command = update.message.text.strip() # Strip whitespace for exact match
-        settings = get_chat_settings_db(session, chat_id) # Get chat specific settings
+@reply_commands.command("بن", role=ADMIN, needs=(NEEDS_TARGET,))
+async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Bans the author of the replied message."""
+    try:
+        await context.bot.ban_chat_member(chat_id=cmd.chat_id, user_id=cmd.target_user_id)
+        await update.message.reply_text(f"{cmd.target_user_name} از گروه بن شد.", parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Error banning user: {e}")
+        await update.message.reply_text("متاسفانه نتوانستم کاربر را بن کنم. (شاید ربات مجوز ندارد یا کاربر ادمین است)")
 
-        # Pin Message
-        if command == "پین":
-            try:
-                await context.bot.pin_chat_message(
-                    chat_id=chat_id,
-                    message_id=update.message.reply_to_message.message_id,
-                    disable_notification=False
-                )
-                await update.message.reply_text("پیام پین شد.")
-            except Exception as e:
-                logger.error(f"Error pinning message: {e}")
-                await update.message.reply_text("متاسفانه نتوانستم پیام را پین کنم. (شاید ربات مجوز ندارد)")
+@reply_commands.command("رفع بن", role=ADMIN, needs=(NEEDS_TARGET,), resolve_target=_target_from_replied_id)
+async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Unbans the user whose numeric ID is in the replied message."""
+    try:
+        # Ensure the user is actually banned before trying to unban (the router usually fetched the member already)
+        chat_member_status = cmd.target_member or await context.bot.get_chat_member(cmd.chat_id, cmd.target_user_id)
+        if chat_member_status.status == ChatMember.BANNED:
+            await context.bot.unban_chat_member(chat_id=cmd.chat_id, user_id=cmd.target_user_id)
+            await update.message.reply_text(f"{cmd.target_user_name} از بن خارج شد.", parse_mode='HTML')
+        else:
+            await update.message.reply_text(f"{cmd.target_user_name} در حال حاضر بن نیست.")
+    except Exception as e:
+        logger.error(f"Error unbanning user: {e}")
+        await update.message.reply_text("متاسفانه نتوانستم کاربر را رفع بن کنم. (شاید ربات مجوز ندارد یا آیدی نامعتبر است)")
 
-        # Ban User
-        elif command == "بن":
-            try:
-                await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_user_id)
-                await update.message.reply_text(f"{target_user_name} از گروه بن شد.", parse_mode='HTML')
-            except Exception as e:
-                logger.error(f"Error banning user: {e}")
-                await update.message.reply_text("متاسفانه نتوانستم کاربر را بن کنم. (شاید ربات مجوز ندارد یا کاربر ادمین است)")
+@reply_commands.command("اخطار", role=ADMIN, needs=(NEEDS_TARGET, NEEDS_SETTINGS))
+async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Gives the author of the replied message a warning in this chat and bans them at the chat's limit."""
+    settings = cmd.settings
+    current_warnings = database.add_warning(cmd.chat_id, cmd.target_user_id, WARNING_EXPIRY_SECONDS)
 
-        # Unban User
-        elif command == "رفع بن":
-            try:
-                # Ensure the user is actually banned before trying to unban
-                chat_member_status = await context.bot.get_chat_member(chat_id, target_user_id)
-                if chat_member_status.status == ChatMember.BANNED:
-                    await context.bot.unban_chat_member(chat_id=chat_id, user_id=target_user_id)
-                    await update.message.reply_text(f"{target_user_name} از بن خارج شد.", parse_mode='HTML')
-                else:
-                    await update.message.reply_text(f"{target_user_name} در حال حاضر بن نیست.")
-            except Exception as e:
-                logger.error(f"Error unbanning user: {e}")
-                await update.message.reply_text("متاسفانه نتوانستم کاربر را رفع بن کنم. (شاید ربات مجوز ندارد یا آیدی نامعتبر است)")
-
-        # Warning System
-        elif command == "اخطار":
-            target_user_db.warnings += 1
-            session.commit() # Save changes to DB
-            current_warnings = target_user_db.warnings
-            
-            if current_warnings >= settings.warning_limit: # Use limit from DB
-                try:
-                    await context.bot.ban_chat_member(chat_id=chat_id, user_id=target_user_id)
-                    await update.message.reply_text(
-                        f"{target_user_name} به دلیل رسیدن به {settings.warning_limit} اخطار از گروه بن شد.",
-                        parse_mode='HTML'
-                    )
-                    target_user_db.warnings = 0 # Reset warnings after ban
-                    session.commit()
-                except Exception as e:
-                    logger.error(f"Error banning user after warnings: {e}")
-                    await update.message.reply_text("متاسفانه نتوانستم کاربر را بن کنم. (شاید ربات مجوز ندارد یا کاربر ادمین است)")
-            else:
-                await update.message.reply_text(
-                    f"{target_user_name} اخطار گرفت. تعداد اخطارهای فعلی: {current_warnings}/{settings.warning_limit}",
-                    parse_mode='HTML'
-                )
-        
-        # Set Warning Limit
-        elif command.startswith("تنظیم اخطار"):
-            try:
-                parts = command.split()
-                if len(parts) < 3: # Check for "تنظیم", "اخطار", and the number
-                    await update.message.reply_text("فرمت صحیح: تنظیم اخطار <عدد>")
-                    return
-                new_limit = int(parts[2])
-                if new_limit > 0:
-                    settings.warning_limit = new_limit
-                    session.commit() # Save to DB
-                    await update.message.reply_text(f"حد اخطار به {new_limit} تنظیم شد.")
-                else:
-                    await update.message.reply_text("عدد اخطار باید مثبت باشد.")
-            except (ValueError, IndexError):
-                await update.message.reply_text("فرمت صحیح: تنظیم اخطار <عدد>")
-        
-        # Mute User
-        elif command.startswith("سکوت"):
-            try:
-                parts = command.split()
-                if len(parts) < 2:
-                    await update.message.reply_text("لطفاً مدت سکوت را به دقیقه وارد کنید. مثال: سکوت 30")
-                    return
-                
-                mute_duration_minutes = int(parts[1])
-                if mute_duration_minutes <= 0:
-                    await update.message.reply_text("مدت سکوت باید مثبت باشد.")
-                    return
-
-                until_date = datetime.now() + timedelta(minutes=mute_duration_minutes)
-                
-                await context.bot.restrict_chat_member(
-                    chat_id=chat_id,
-                    user_id=target_user_id,
-                    permissions=ChatMember.ALL_PERMISSIONS.with_can_send_messages(False), # Restrict sending messages
-                    until_date=until_date
-                )
-                await update.message.reply_text(
-                    f"{target_user_name} به مدت {mute_duration_minutes} دقیقه سکوت شد.",
-                    parse_mode='HTML'
-                )
-            except (ValueError, IndexError):
-                await update.message.reply_text("فرمت صحیح: سکوت <عدد به دقیقه>")
-            except Exception as e:
-                logger.error(f"Error muting user: {e}")
-                await update.message.reply_text("متاسفانه نتوانستم کاربر را سکوت کنم. (شاید ربات مجوز ندارد یا کاربر ادمین است)")
+    if current_warnings >= settings.warning_limit: # Use limit from DB
+        try:
+            await context.bot.ban_chat_member(chat_id=cmd.chat_id, user_id=cmd.target_user_id)
+            await update.message.reply_text(
+                f"{cmd.target_user_name} به دلیل رسیدن به {settings.warning_limit} اخطار از گروه بن شد.",
+                parse_mode='HTML'
+            )
+            database.reset_warnings(cmd.chat_id, cmd.target_user_id) # Reset warnings after ban
+        except Exception as e:
+            logger.error(f"Error banning user after warnings: {e}")
+            await update.message.reply_text("متاسفانه نتوانستم کاربر را بن کنم. (شاید ربات مجوز ندارد یا کاربر ادمین است)")
+    else:
+        await update.message.reply_text(
+            f"{cmd.target_user_name} اخطار گرفت. تعداد اخطارهای فعلی: {current_warnings}/{settings.warning_limit}",
+            parse_mode='HTML'
+        )
 
-        # Promote User to Admin
-        elif command == "ادمین":
-            try:
-                # Bot needs to be admin with 'Add New Admins' permission
-                # If target user is already admin, Telegram raises BadRequest
-                chat_member = await context.bot.get_chat_member(chat_id=chat_id, user_id=target_user_id)
-                if chat_member.status in ["creator", "administrator"]:
-                    await update.message.reply_text(f"{target_user_name} در حال حاضر ادمین است.")
-                    return
-
-                await context.bot.promote_chat_member(
-                    chat_id=chat_id,
-                    user_id=target_user_id,
-                    can_change_info=True,
-                    can_delete_messages=True,
-                    can_invite_users=True,
-                    can_restrict_members=True,
-                    can_pin_messages=True,
-                    can_promote_members=False, # Bot shouldn't give permission to promote members to new admins
-                    can_manage_chat=True,
-                    can_manage_video_chats=True,
-                    can_post_messages=True,
-                    can_edit_messages=True,
-                    is_anonymous=False # Should not be anonymous by default
-                )
-                await update.message.reply_text(f"{target_user_name} به عنوان ادمین گروه اضافه شد.", parse_mode='HTML')
-            except Exception as e:
-                logger.error(f"Error promoting user to admin: {e}")
-                await update.message.reply_text("متاسفانه نتوانستم کاربر را ادمین کنم. (شاید ربات مجوز 'افزودن مدیران جدید' را ندارد یا کاربر ادمین است)")
-
-        # Set Welcome Message Text (Admin only)
-        elif command == "تنظیم خوشامد متن":
-            if update.message.reply_to_message and update.message.reply_to_message.text:
-                settings.welcome_text = update.message.reply_to_message.text
-                session.commit()
-                await update.message.reply_text("متن خوشامدگویی با موفقیت تنظیم شد.")
-            else:
-                await update.message.reply_text("لطفاً روی پیامی که حاوی متن خوشامدگویی جدید است ریپلای کنید و 'تنظیم خوشامد متن' را بنویسید.")
-
-        # Set Welcome Message Media (Admin only)
-        elif command == "تنظیم خوشامد رسانه":
-            if update.message.reply_to_message:
-                if update.message.reply_to_message.photo:
-                    settings.welcome_media_id = update.message.reply_to_message.photo[-1].file_id # Get largest photo
-                    settings.welcome_media_type = 'photo'
-                    session.commit()
-                    await update.message.reply_text("تصویر خوشامدگویی با موفقیت تنظیم شد.")
-                elif update.message.reply_to_message.video:
-                    settings.welcome_media_id = update.message.reply_to_message.video.file_id
-                    settings.welcome_media_type = 'video'
-                    session.commit()
-                    await update.message.reply_text("ویدیوی خوشامدگویی با موفقیت تنظیم شد.")
-                else:
-                    await update.message.reply_text("لطفاً روی یک تصویر یا ویدیو ریپلای کنید و 'تنظیم خوشامد رسانه' را بنویسید.")
-            else:
-                await update.message.reply_text("لطفاً روی یک تصویر یا ویدیو ریپلای کنید و 'تنظیم خوشامد رسانه' را بنویسید.")
-    except Exception as e:
-        session.rollback()
-        logger.error(f"Error in admin_actions_on_reply: {e}")
-    finally:
-        session.close()
+@reply_commands.command("تنظیم اخطار", role=ADMIN, needs=(NEEDS_SETTINGS,), takes_args=True)
+async def set_warning_limit(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Sets the number of warnings that leads to a ban."""
+    try:
+        new_limit = int(cmd.args[0])
+    except (ValueError, IndexError):
+        await update.message.reply_text("فرمت صحیح: تنظیم اخطار <عدد>")
+        return
 
-# --- Group Owner Capabilities ---
+    if new_limit > 0:
+        cmd.settings.warning_limit = new_limit
+        cmd.session.commit() # Save to DB
+        await update.message.reply_text(f"حد اخطار به {new_limit} تنظیم شد.")
+    else:
+        await update.message.reply_text("عدد اخطار باید مثبت باشد.")
+
+@reply_commands.command("سکوت", role=ADMIN, needs=(NEEDS_TARGET,), takes_args=True)
+async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Mutes the author of the replied message for the given number of minutes."""
+    if not cmd.args:
+        await update.message.reply_text("لطفاً مدت سکوت را به دقیقه وارد کنید. مثال: سکوت 30")
+        return
+    try:
+        mute_duration_minutes = int(cmd.args[0])
+    except ValueError:
+        await update.message.reply_text("فرمت صحیح: سکوت <عدد به دقیقه>")
+        return
+    if mute_duration_minutes <= 0:
+        await update.message.reply_text("مدت سکوت باید مثبت باشد.")
+        return
 
-async def owner_actions_on_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles group owner actions triggered by replying to a message."""
-    session = Session()
     try:
-        if not update.message.reply_to_message or not update.message.text:
-            return # Not a reply or no text in the message
+        until_date = datetime.now() + timedelta(minutes=mute_duration_minutes)
+        await context.bot.restrict_chat_member(
+            chat_id=cmd.chat_id,
+            user_id=cmd.target_user_id,
+            permissions=ChatPermissions(can_send_messages=False), # Restrict sending messages
+            until_date=until_date
+        )
+        await update.message.reply_text(
+            f"{cmd.target_user_name} به مدت {mute_duration_minutes} دقیقه سکوت شد.",
+            parse_mode='HTML'
+        )
+    except Exception as e:
+        logger.error(f"Error muting user: {e}")
+        await update.message.reply_text("متاسفانه نتوانستم کاربر را سکوت کنم. (شاید ربات مجوز ندارد یا کاربر ادمین است)")
 
-        # Check if the user is the group creator OR the designated bot owner
-        is_owner_or_bot_owner = await is_group_owner(update, context) or \
-                                update.effective_user.id == get_bot_owner_id_db(session)
-        
-        if not is_owner_or_bot_owner:
-            return # Only group owner or bot owner can use these commands (is_group_owner sends a message)
-
-        target_user_id = update.message.reply_to_message.from_user.id
-        target_user_info = await context.bot.get_chat_member(chat_id=update.effective_chat.id, user_id=target_user_id)
-        target_user_name = target_user_info.user.first_name if target_user_info.user.first_name else "کاربر"
-        if target_user_info.user.last_name:
-            target_user_name += f" {target_user_info.user.last_name}"
-        if target_user_info.user.username:
-            target_user_name += f" (@{target_user_info.user.username})"
-
-        # Ensure target_user exists in our DB if we're going to modify it
-        target_user_db = get_or_create_user_db(
-            session,
-            target_user_id,
-            target_user_info.user.username,
-            target_user_info.user.first_name,
-            target_user_info.user.last_name
+@reply_commands.command("ادمین", role=ADMIN, needs=(NEEDS_TARGET,))
+async def promote_user(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Promotes the author of the replied message to admin."""
+    try:
+        # Bot needs to be admin with 'Add New Admins' permission
+        # If target user is already admin, Telegram raises BadRequest
+        chat_member = await context.bot.get_chat_member(chat_id=cmd.chat_id, user_id=cmd.target_user_id)
+        if chat_member.status in ["creator", "administrator"]:
+            await update.message.reply_text(f"{cmd.target_user_name} در حال حاضر ادمین است.")
+            return
+
+        await context.bot.promote_chat_member(
+            chat_id=cmd.chat_id,
+            user_id=cmd.target_user_id,
+            can_change_info=True,
+            can_delete_messages=True,
+            can_invite_users=True,
+            can_restrict_members=True,
+            can_pin_messages=True,
+            can_promote_members=False, # Bot shouldn't give permission to promote members to new admins
+            can_manage_chat=True,
+            can_manage_video_chats=True,
+            can_post_messages=True,
+            can_edit_messages=True,
+            is_anonymous=False # Should not be anonymous by default
         )
+        await update.message.reply_text(f"{cmd.target_user_name} به عنوان ادمین گروه اضافه شد.", parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Error promoting user to admin: {e}")
+        await update.message.reply_text("متاسفانه نتوانستم کاربر را ادمین کنم. (شاید ربات مجوز 'افزودن مدیران جدید' را ندارد یا کاربر ادمین است)")
+
+@reply_commands.command("تنظیم خوشامد متن", role=ADMIN, needs=(NEEDS_SETTINGS,))
+async def set_welcome_text(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Sets the welcome text from the replied message."""
+    new_text = update.message.reply_to_message.text
+    if not new_text:
+        await update.message.reply_text("لطفاً روی پیامی که حاوی متن خوشامدگویی جدید است ریپلای کنید و 'تنظیم خوشامد متن' را بنویسید.")
+        return
+    try:
+        compile_template(new_text)
+    except TemplateError as e:
+        await update.message.reply_text(f"متن خوشامدگویی نامعتبر است: {e}")
+        return
 
-        command = update.message.text.strip() # Strip whitespace for exact match
+    cmd.settings.welcome_text = new_text
+    cmd.session.commit()
+    invalidate_welcome_cache(cmd.chat_id)
+    await update.message.reply_text("متن خوشامدگویی با موفقیت تنظیم شد.")
+
+@reply_commands.command("تنظیم خوشامد رسانه", role=ADMIN, needs=(NEEDS_SETTINGS,))
+async def set_welcome_media(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Sets the welcome photo or video from the replied message."""
+    reply = update.message.reply_to_message
+    if reply.photo:
+        cmd.settings.welcome_media_id = reply.photo[-1].file_id # Get largest photo
+        cmd.settings.welcome_media_type = 'photo'
+        success_text = "تصویر خوشامدگویی با موفقیت تنظیم شد."
+    elif reply.video:
+        cmd.settings.welcome_media_id = reply.video.file_id
+        cmd.settings.welcome_media_type = 'video'
+        success_text = "ویدیوی خوشامدگویی با موفقیت تنظیم شد."
+    else:
+        await update.message.reply_text("لطفاً روی یک تصویر یا ویدیو ریپلای کنید و 'تنظیم خوشامد رسانه' را بنویسید.")
+        return
 
-        # Special User
-        if command == "کاربر ویژه":
-            target_user_db.is_special = True
-            session.commit()
-            await update.message.reply_text(f"{target_user_name} به عنوان کاربر ویژه اضافه شد. او اکنون می‌تواند لینک ارسال کند.", parse_mode='HTML')
-        
-        # Bot Owner (Only group creator can set bot owner initially)
-        elif command == "مالک ربات":
-            # Extra check to ensure only the actual group creator can assign bot owner
-            # to prevent a non-creator bot owner from changing the bot owner
-            if not await is_group_owner(update, context): 
-                await update.message.reply_text("این دستور فقط توسط سازنده گروه قابل استفاده است تا مالک ربات را تعیین کند.")
-                return
+    cmd.session.commit()
+    invalidate_welcome_cache(cmd.chat_id)
+    await update.message.reply_text(success_text)
+
+# --- Bulk Moderation ---
+
+BULK_MODERATION_CONCURRENCY = int(os.environ.get("BULK_MODERATION_CONCURRENCY", 5)) # API calls in flight per job
+MAX_BULK_TARGETS = 1000
+# Joins are remembered this long for "اخیر <minutes>"; finished jobs can be resumed for this long
+JOIN_RECORD_RETENTION_SECONDS = int(os.environ.get("JOIN_RECORD_RETENTION_HOURS", 48)) * 60 * 60
+MODERATION_JOB_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+BULK_ACTION_NAMES = {
+    moderation.BAN: "بن گروهی",
+    moderation.UNBAN: "رفع بن گروهی",
+    moderation.MUTE: "سکوت گروهی",
+}
+RECENT_JOINS_KEYWORD = "اخیر"
+
+_USER_ID_PATTERN = re.compile(r'(?<!\d)\d{5,}(?!\d)') # Telegram user ids, in a pasted list or any text
+running_moderation_jobs = set() # job ids being run, so a resume can't run a job twice at once
 
-            set_bot_owner_id_db(session, target_user_id)
-            await update.message.reply_text(f"{target_user_name} به عنوان مالک ربات تعیین شد. او اکنون قابلیت‌های مالک گروه را دارد.", parse_mode='HTML')
+async def _bulk_targets(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext, args):
+    """
+    Collects the users for a bulk command: `اخیر <minutes>` selects everyone who joined in the
+    last N minutes, ids given as arguments are used as-is, otherwise every id in the replied
+    message. Returns a list of ids, or None after telling the admin what was wrong.
+    """
+    if args and args[0] == RECENT_JOINS_KEYWORD:
+        try:
+            minutes = int(args[1])
+        except (IndexError, ValueError):
+            minutes = 0
+        if minutes <= 0:
+            await update.message.reply_text(f"فرمت صحیح: {RECENT_JOINS_KEYWORD} <عدد به دقیقه>")
+            return None
+        user_ids = database.get_recent_joins(cmd.chat_id, int(time.time()) - minutes * 60)
+    elif args:
+        if not all(arg.isdigit() for arg in args):
+            await update.message.reply_text("آیدی‌ها باید عددی باشند.")
+            return None
+        user_ids = [int(arg) for arg in args]
+    else:
+        reply = update.message.reply_to_message
+        text = reply.text or reply.caption or ""
+        user_ids = [int(user_id) for user_id in _USER_ID_PATTERN.findall(text)]
+
+    excluded = {context.bot.id, update.effective_user.id}
+    user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in excluded] # Dedupe, keep order
+    if len(user_ids) > MAX_BULK_TARGETS:
+        await update.message.reply_text(f"حداکثر {MAX_BULK_TARGETS} کاربر در هر عملیات. فقط {MAX_BULK_TARGETS} کاربر اول انجام می‌شود.")
+        user_ids = user_ids[:MAX_BULK_TARGETS]
+    return user_ids
+
+def _moderation_summary(job_id, action, counts, errors):
+    total = sum(counts.values())
+    done = counts.get(moderation.DONE, 0)
+    failed = counts.get(moderation.FAILED, 0)
+    pending = counts.get(moderation.PENDING, 0)
+    lines = [f"عملیات #{job_id} ({BULK_ACTION_NAMES[action]}): {done} موفق، {failed} ناموفق از {total} کاربر."]
+    if pending:
+        lines.append(f"{pending} کاربر انجام نشد (عملیات متوقف شد).")
+    for user_id, error in errors:
+        lines.append(f"- {user_id}: {error}")
+    if failed or pending:
+        lines.append(f"برای تلاش دوباره روی همین پیام ریپلای کن و بنویس 'ادامه عملیات {job_id}'.")
+    return "\n".join(lines)
+
+async def _run_moderation_job(bot, job_id, status_message):
+    """Runs the unfinished users of a bulk job and turns the status message into a summary."""
+    running_moderation_jobs.add(job_id)
+    try:
+        chat_id, action, duration_seconds = database.get_moderation_job(job_id)
+        user_ids = database.get_unfinished_moderation_items(job_id)
+        bulk_action = moderation.BulkAction(
+            bot, chat_id, action, duration_seconds, concurrency=BULK_MODERATION_CONCURRENCY
+        )
+        try:
+            await bulk_action.run(
+                user_ids, on_results=lambda rows: database.set_moderation_item_results(job_id, rows)
+            )
+        except Exception as e:
+            logger.error(f"Bulk moderation job {job_id} stopped: {e}")
+
+        counts, errors = database.get_moderation_job_summary(job_id)
+        summary = _moderation_summary(job_id, action, counts, errors)
+        try:
+            await status_message.edit_text(summary)
+        except Exception:
+            await bot.send_message(chat_id=chat_id, text=summary)
     except Exception as e:
-        session.rollback()
-        logger.error(f"Error in owner_actions_on_reply: {e}")
+        logger.error(f"Error in bulk moderation job {job_id}: {e}")
     finally:
-        session.close()
+        running_moderation_jobs.discard(job_id)
 
-# --- Statistics ---
+async def _start_bulk_action(update, context, cmd, action, args, duration_seconds=None):
+    user_ids = await _bulk_targets(update, context, cmd, args)
+    if user_ids is None:
+        return
+    if not user_ids:
+        await update.message.reply_text("هیچ کاربری برای این عملیات پیدا نشد.")
+        return
 
-async def update_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Updates user chat statistics."""
-    # Ensure there's a message and it's from a user (not a channel, etc.)
-    if not update.effective_user or not update.message:
+    job_id = database.create_moderation_job(cmd.chat_id, action, user_ids, update.effective_user.id, duration_seconds)
+    status_message = await update.message.reply_text(
+        f"عملیات #{job_id} ({BULK_ACTION_NAMES[action]}) برای {len(user_ids)} کاربر شروع شد..."
+    )
+    # Runs outside the update so other messages keep being handled; shutdown waits for it
+    context.application.create_task(_run_moderation_job(context.bot, job_id, status_message))
+
+@reply_commands.command("بن گروهی", role=ADMIN, takes_args=True)
+async def bulk_ban(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Bans every listed user (ids in the replied message or arguments, or 'اخیر <minutes>')."""
+    await _start_bulk_action(update, context, cmd, moderation.BAN, cmd.args)
+
+@reply_commands.command("رفع بن گروهی", role=ADMIN, takes_args=True)
+async def bulk_unban(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Unbans every listed user that is banned."""
+    await _start_bulk_action(update, context, cmd, moderation.UNBAN, cmd.args)
+
+@reply_commands.command("سکوت گروهی", role=ADMIN, takes_args=True)
+async def bulk_mute(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Mutes every listed user for the given number of minutes."""
+    try:
+        mute_duration_minutes = int(cmd.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("فرمت صحیح: سکوت گروهی <عدد به دقیقه> (و در صورت نیاز آیدی‌ها یا 'اخیر <دقیقه>')")
+        return
+    if mute_duration_minutes <= 0:
+        await update.message.reply_text("مدت سکوت باید مثبت باشد.")
         return
+    await _start_bulk_action(update, context, cmd, moderation.MUTE, cmd.args[1:], mute_duration_minutes * 60)
 
-    session = Session()
+@reply_commands.command("ادامه عملیات", role=ADMIN, takes_args=True)
+async def resume_bulk_action(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Retries the users of a bulk job that failed or were never reached."""
     try:
-        user_id = update.effective_user.id
-        user = get_or_create_user_db(
-            session,
-            user_id,
-            update.effective_user.username,
-            update.effective_user.first_name,
-            update.effective_user.last_name
-        )
-        
-        user.total_messages += 1
+        job_id = int(cmd.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("فرمت صحیح: ادامه عملیات <شماره عملیات>")
+        return
 
-        now = datetime.now()
-        last_time = user.last_message_time if user.last_message_time else datetime.min
+    job = database.get_moderation_job(job_id)
+    if job is None or job[0] != cmd.chat_id:
+        await update.message.reply_text("عملیاتی با این شماره در این گروه پیدا نشد.")
+        return
+    if job_id in running_moderation_jobs:
+        await update.message.reply_text("این عملیات در حال اجراست.")
+        return
+    remaining = database.get_unfinished_moderation_items(job_id)
+    if not remaining:
+        await update.message.reply_text("همه کاربران این عملیات قبلاً انجام شده‌اند.")
+        return
 
-        # Reset daily if new day (or new month/year, covers all)
-        if now.day != last_time.day or now.month != last_time.month or now.year != last_time.year:
-            user.daily_messages = 0
-        user.daily_messages += 1
+    status_message = await update.message.reply_text(f"ادامه عملیات #{job_id} برای {len(remaining)} کاربر...")
+    context.application.create_task(_run_moderation_job(context.bot, job_id, status_message))
 
-        # Reset hourly if new hour (or new day, covers all)
-        if now.hour != last_time.hour or now.day != last_time.day:
-            user.hourly_messages = 0
-        user.hourly_messages += 1
+# --- Group Owner Capabilities ---
 
-        # Reset weekly (using ISO week number, which resets at the start of a new ISO year)
-        # Check for change in week number OR year
-        if now.isocalendar()[1] != last_time.isocalendar()[1] or now.year != last_time.year:
-            user.weekly_messages = 0
-        user.weekly_messages += 1
+@reply_commands.command("کاربر ویژه", role=OWNER, needs=(NEEDS_TARGET, NEEDS_TARGET_DB))
+async def make_special_user(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Marks the author of the replied message as a special user who may post any link."""
+    cmd.target_user_db.is_special = True
+    user_cache.mark_dirty(cmd.target_user_db)
+    user_cache.flush() # Persist right away rather than with the next batch
+    await update.message.reply_text(f"{cmd.target_user_name} به عنوان کاربر ویژه اضافه شد. او اکنون می‌تواند لینک ارسال کند.", parse_mode='HTML')
+
+@reply_commands.command("مالک ربات", role=OWNER, needs=(NEEDS_TARGET,))
+async def set_bot_owner(update: Update, context: ContextTypes.DEFAULT_TYPE, cmd: CommandContext) -> None:
+    """Makes the author of the replied message the bot owner."""
+    # Extra check to ensure only the actual group creator can assign bot owner
+    # to prevent a non-creator bot owner from changing the bot owner
+    if not await is_group_owner(update, context):
+        await update.message.reply_text("این دستور فقط توسط سازنده گروه قابل استفاده است تا مالک ربات را تعیین کند.")
+        return
 
-        # Reset monthly if new month (or new year, covers all)
-        if now.month != last_time.month or now.year != last_time.year:
-            user.monthly_messages = 0
-        user.monthly_messages += 1
+    set_bot_owner_id_db(cmd.session, cmd.target_user_id)
+    await update.message.reply_text(f"{cmd.target_user_name} به عنوان مالک ربات تعیین شد. او اکنون قابلیت‌های مالک گروه را دارد.", parse_mode='HTML')
 
-        user.last_message_time = now
-        session.commit()
+# --- Statistics ---
+
+activity_versions = {} # chat_id -> number of activity writes, so cached analytics know when new data arrived
+
+async def update_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Updates user chat statistics."""
+    # Ensure there's a message and it's from a user (not a channel, etc.)
+    if not update.effective_user or not update.message:
+        return
+
+    traffic_monitor.record() # Database maintenance waits for quiet periods
+    try:
+        user = get_cached_user(update.effective_user)
+        user.record_message(datetime.now())
+        user_cache.mark_dirty(user)
+
+        # Per-chat activity (daily history and heatmap) for group analytics
+        if update.effective_chat.type in ["group", "supergroup"]:
+            chat_id = update.effective_chat.id
+            database.update_user_stats(chat_id, user.id, update.effective_user.username, update.effective_user.full_name)
+            activity_versions[chat_id] = activity_versions.get(chat_id, 0) + 1
     except Exception as e:
-        session.rollback()
         logger.error(f"Error updating user stats: {e}")
-    finally:
-        session.close()
 
 async def my_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows personal chat statistics."""
-    session = Session()
-    try:
-        user_id = update.effective_user.id
-        user = session.query(User).filter_by(id=user_id).first()
-        
-        if not user:
-            await update.message.reply_text("شما هنوز چتی در این گروه نداشته‌اید یا آمار شما ثبت نشده است.")
-            return
+    ensure_schema()
+    user = user_cache.get(update.effective_user.id)
 
-        profile_text = f"""
+    if not user:
+        await update.message.reply_text("شما هنوز چتی در این گروه نداشته‌اید یا آمار شما ثبت نشده است.")
+        return
+
+    profile_text = f"""
 **پروفایل شما:**
 نام کاربری: {user.first_name} {user.last_name if user.last_name else ''} {f"(@{user.username})" if user.username else ''}
 آیدی عددی: `{user.id}`
@@ -797,15 +1219,14 @@ async def my_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 تعداد چت این هفته: {user.weekly_messages}
 تعداد چت این ماه: {user.monthly_messages}
 """
-        await update.message.reply_html(profile_text)
-    finally:
-        session.close()
+    await update.message.reply_html(profile_text)
 
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows overall group chat statistics and ranking."""
+    user_cache.flush() # Counters are written in batches; make the ranking current
     session = Session()
     try:
-        users = session.query(User).order_by(User.total_messages.desc()).limit(10).all()
+        users = session.query(models.User).order_by(models.User.total_messages.desc()).limit(10).all()
         
         if not users:
             await update.message.reply_text("هنوز آماری برای نمایش وجود ندارد.")
@@ -825,88 +1246,185 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     finally:
         session.close()
 
+async def show_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Shows activity analytics for the group (admins only)."""
+    if not await is_admin_or_creator(update, context):
+        return
+
+    chat_id = update.effective_chat.id
+    try:
+        ensure_schema()
+        # The report is cached per chat until new activity is recorded; computing it runs off the event loop
+        report = await asyncio.to_thread(analytics.get_chat_report, chat_id, activity_versions.get(chat_id, 0))
+        await update.message.reply_html(analytics.format_report(report, html.escape(update.effective_chat.title or "")))
+    except Exception as e:
+        logger.error(f"Error building analytics for chat {chat_id}: {e}")
+        await update.message.reply_text("متاسفانه در حال حاضر امکان نمایش آمار فعالیت وجود ندارد.")
+
+# Telegram bots can't upload documents larger than this
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+async def export_chat_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Sends the group's member stats and activity history as a compressed file (admins only)."""
+    if not await is_admin_or_creator(update, context):
+        return
+
+    fmt = context.args[0].lower() if context.args else 'csv'
+    if fmt not in stats_export.FORMATS:
+        await update.message.reply_text("فرمت صحیح: /export یا /export csv یا /export jsonl")
+        return
+
+    chat_id = update.effective_chat.id
+    await update.message.reply_text("در حال آماده‌سازی فایل آمار، لطفاً منتظر بمانید...")
+
+    fd, path = tempfile.mkstemp(prefix=f"export_{abs(chat_id)}_", suffix=".zip")
+    os.close(fd)
+    try:
+        ensure_schema()
+        # Written in chunks in a worker thread, so neither memory nor the event loop suffer on large groups
+        counts = await asyncio.to_thread(stats_export.write_chat_export, chat_id, path, fmt)
+        if os.path.getsize(path) > MAX_UPLOAD_BYTES:
+            await update.message.reply_text("فایل آمار بزرگ‌تر از حد مجاز تلگرام (50 مگابایت) است.")
+            return
+        with open(path, 'rb') as document:
+            await update.message.reply_document(
+                document=document,
+                filename=f"stats_{abs(chat_id)}_{datetime.now():%Y%m%d}.zip",
+                caption=f"آمار گروه: {counts['members']} عضو، {counts['activity']} ردیف فعالیت ({fmt})"
+            )
+    except Exception as e:
+        logger.error(f"Error exporting stats for chat {chat_id}: {e}")
+        await update.message.reply_text("متاسفانه در ساخت فایل آمار مشکلی پیش آمد.")
+    finally:
+        os.remove(path)
+
+# --- Background Maintenance ---
+
+background_jobs = BackgroundJobs()
+
+traffic_monitor = db_maintenance.TrafficMonitor()
+database_maintenance = db_maintenance.DatabaseMaintenance(
+    traffic_monitor,
+    # Heavier steps (ANALYZE, WAL truncation, vacuum) only run below this many messages per minute
+    quiet_messages_per_minute=float(os.environ.get("DB_MAINTENANCE_QUIET_MESSAGES_PER_MINUTE", 5)),
+    # Older databases up to this size are converted to incremental auto-vacuum with a blocking full VACUUM
+    convert_max_bytes=int(float(os.environ.get("DB_VACUUM_CONVERT_MAX_MB", 4)) * 1024 * 1024)
+)
+
+@background_jobs.every(int(os.environ.get("USER_CACHE_FLUSH_SECONDS", 10)))
+def flush_user_cache():
+    """Writes changed user records back to the users table in one batch."""
+    user_cache.flush()
+
+@background_jobs.every(60 * 60, first=5 * 60)
+def prune_expired_warnings():
+    """Removes expired warnings so the ledger only holds live ones."""
+    ensure_schema()
+    deleted = database.prune_expired_warnings()
+    if deleted:
+        logger.info(f"Pruned {deleted} expired warnings.")
+
+@background_jobs.every(60 * 60, first=10 * 60)
+def prune_moderation_records():
+    """Forgets old join records and bulk moderation jobs."""
+    ensure_schema()
+    now = int(time.time())
+    joins, jobs = database.prune_moderation_records(
+        now - JOIN_RECORD_RETENTION_SECONDS, now - MODERATION_JOB_RETENTION_SECONDS
+    )
+    if joins or jobs:
+        logger.info(f"Pruned {joins} join records and {jobs} bulk moderation jobs.")
+
+@background_jobs.every(int(os.environ.get("DB_MAINTENANCE_INTERVAL_MINUTES", 15)) * 60, first=2 * 60)
+def maintain_database():
+    """Checkpoints the WAL and, when the bot is quiet, analyzes, vacuums in small slices and refreshes the size metrics."""
+    ensure_schema()
+    database_maintenance.run()
+
+@background_jobs.every(6 * 60 * 60, first=15 * 60)
+def compact_activity():
+    """Rolls old daily activity into weekly/monthly totals. Large backlogs are worked off over several runs."""
+    ensure_schema()
+    days_rolled, weeks_rolled = database.compact_activity(DAILY_ACTIVITY_RETENTION_DAYS, WEEKLY_ACTIVITY_RETENTION_DAYS)
+    if days_rolled or weeks_rolled:
+        logger.info(f"Activity compaction rolled up {days_rolled} daily rows and {weeks_rolled} weekly rows.")
+
 # --- Main function to run the bot ---
 
+async def on_startup(application: Application) -> None:
+    """Runs once the application is initialized, right before polling starts."""
+    global bot_loop
+    bot_loop = asyncio.get_running_loop()
+    startup_timer.report()
+    background_jobs.start()
+
+async def on_shutdown() -> None:
+    """Stops background jobs, writes back cached users and releases the database connections once all handlers have finished."""
+    await background_jobs.stop()
+    try:
+        user_cache.flush()
+    except Exception as e:
+        logger.error(f"Error flushing user cache on shutdown: {e}")
+    if models.loaded:
+        models.engine.dispose()
+
+def build_application() -> Application:
+    """Builds the application and registers all handlers."""
+    application = Application.builder().token(TOKEN).post_init(on_startup).build()
+
+    # Command Handlers
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("translate", translate_text))
+    application.add_handler(CommandHandler("download", download_command_handler))
+    application.add_handler(CommandHandler("myprofile", my_profile))
+    application.add_handler(CommandHandler("stats", show_stats))
+    application.add_handler(CommandHandler("analytics", show_analytics))
+    application.add_handler(CommandHandler("export", export_chat_stats))
+
+    # Message Handler for group link management
+    application.add_handler(MessageHandler(filters.TEXT & filters.ChatType.GROUPS & filters.Regex(r'https?://[^\s]+'), manage_group_links))
+
+    # Message Handler for new members (welcome message)
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, greet_new_members))
+
+    # Single handler for every reply keyword command (ترجمه, admin and owner commands).
+    # The keyword is matched once by ReplyCommandFilter and dispatched through reply_commands.
+    application.add_handler(MessageHandler(
+        filters.TEXT & filters.REPLY & ~filters.COMMAND & ReplyCommandFilter(reply_commands),
+        route_reply_command
+    ))
+
+    # Message Handler for all text messages to update stats.
+    # It lives in its own handler group so it runs in addition to the handlers above
+    # (only the first matching handler of a group is run).
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, update_user_stats), group=1)
+
+    return application
+
 def main() -> None:
-    """Start the bot and run it continuously with error handling."""
-    # This loop ensures the bot restarts if an error or disconnection occurs.
-    while True:
-        try:
-            logger.info("Initializing DigitalBot...")
-            application = Application.builder().token(TOKEN).build()
-
-            # Command Handlers
-            application.add_handler(CommandHandler("start", start))
-            application.add_handler(CommandHandler("help", help_command))
-            application.add_handler(CommandHandler("translate", translate_text))
-            application.add_handler(CommandHandler("download", download_command_handler))
-            application.add_handler(CommandHandler("myprofile", my_profile))
-            application.add_handler(CommandHandler("stats", show_stats))
-
-            # Message Handler for group link management
-            application.add_handler(MessageHandler(filters.TEXT & filters.ChatType.GROUPS & filters.Regex(r'https?://[^\s]+'), manage_group_links))
-
-            # Message Handler for reply translation (exact match for "ترجمه")
-            application.add_handler(MessageHandler(filters.TEXT & filters.REPLY & filters.Regex(r'^\s*ترجمه\s*$'), reply_translate))
-
-            # Message Handler for new members (welcome message)
-            application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, greet_new_members))
-
-            # Message Handler for all text messages to update stats
-            # IMPORTANT: This should be before other TEXT handlers if you want stats for all messages
-            # But after specific TEXT & REPLY handlers if you only want stats for non-command messages.
-            # Here, it's fine as is, because it explicitly excludes COMMANDs.
-            application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, update_user_stats))
-
-            # Message Handlers for admin/owner actions using regex for exact match or starts-with
-            # Admin commands
-            application.add_handler(MessageHandler(
-                filters.TEXT & filters.REPLY & filters.ChatType.GROUPS &
-                (
-                    filters.Regex(r'^\s*پین\s*$') |
-                    filters.Regex(r'^\s*بن\s*$') |
-                    filters.Regex(r'^\s*رفع بن\s*$') | # New filter for unban
-                    filters.Regex(r'^\s*اخطار\s*$') |
-                    filters.Regex(r'^\s*سکوت\s+.*$') | 
-                    filters.Regex(r'^\s*تنظیم اخطار\s+.*$') | 
-                    filters.Regex(r'^\s*ادمین\s*$') | # New filter for admin
-                    filters.Regex(r'^\s*تنظیم خوشامد متن\s*$') |
-                    filters.Regex(r'^\s*تنظیم خوشامد رسانه\s*$')
-                ),
-                admin_actions_on_reply
-            ))
-            # Owner commands
-            application.add_handler(MessageHandler(
-                filters.TEXT & filters.REPLY & filters.ChatType.GROUPS &
-                (
-                    filters.Regex(r'^\s*کاربر ویژه\s*$') |
-                    filters.Regex(r'^\s*مالک ربات\s*$')
-                ),
-                owner_actions_on_reply
-            ))
-
-            logger.info("DigitalBot started successfully. Listening for updates...")
-            # Run the bot using polling. If an error occurs here, it will go to the except block.
-            application.run_polling(allowed_updates=Update.ALL_TYPES) 
+    """Start the bot and keep it running; network errors reconnect in-process instead of rebuilding everything."""
+    logger.info("Initializing DigitalBot...")
+    with startup_timer.step("build application"):
+        application = build_application()
 
-        except Exception as e:
-            logger.error(f"An error occurred: {e}. Restarting bot in 5 seconds...", exc_info=True)
-            time.sleep(5)
-        finally:
-            pass
+    supervisor = BotSupervisor(application, allowed_updates=Update.ALL_TYPES, shutdown_hooks=[on_shutdown])
+    try:
+        asyncio.run(supervisor.run())
+    except Exception as e:
+        logger.error(f"DigitalBot stopped because of a fatal error: {e}", exc_info=True)
+        raise
 
 # This is the main entry point of the program, running both the Telegram bot and Flask server.
 if __name__ == "__main__":
     # Function to run the Flask server
     def run_flask_app():
         port = int(os.environ.get("PORT", 10000)) 
-        app.run(host='0.0.0.0', port=port)
+        create_flask_app().run(host='0.0.0.0', port=port)
 
-    # Start Flask in a separate thread.
-    flask_thread = Thread(target=run_flask_app)
+    # Start Flask in a separate thread. It is a daemon thread so the process exits once the bot has shut down.
+    flask_thread = Thread(target=run_flask_app, daemon=True)
     flask_thread.start()
 
     # Run the Telegram bot directly in the main thread.
     main()
-
-    flask_thread.join()
@@ -0,0 +1,129 @@
+import numpy as np
+
+import database
+
+# A member counts as active if they wrote something within this many days
+ACTIVE_DAYS = 7
+# Members silent for longer than this count as inactive
+INACTIVE_DAYS = 30
+# Retention is shown for members who first appeared in each of the last N weeks,
+# over N weeks. Cohorts come from the raw daily tier (see database.compact_activity).
+RETENTION_WEEKS = 8
+
+WEEKDAY_NAMES = ["دوشنبه", "سه‌شنبه", "چهارشنبه", "پنجشنبه", "جمعه", "شنبه", "یکشنبه"] # Monday first
+HEATMAP_SHADES = np.array(list(" ░▒▓█"))
+
+_ACTIVITY_DTYPE = np.dtype([('user_id', np.int64), ('days_ago', np.int64), ('count', np.int64)])
+_LAST_ACTIVITY_DTYPE = np.dtype([('user_id', np.int64), ('days_ago', np.int64)])
+
+_report_cache = {} # chat_id -> (data_version, ChatReport)
+
+class ChatReport:
+    """Analytics for one chat, computed from the activity tables with array operations."""
+    __slots__ = ('member_count', 'active_count', 'inactive_count', 'total_messages',
+                 'heatmap', 'cohort_sizes', 'retention')
+
+    def __init__(self, member_count, active_count, inactive_count, total_messages, heatmap, cohort_sizes, retention):
+        self.member_count = member_count
+        self.active_count = active_count
+        self.inactive_count = inactive_count
+        self.total_messages = total_messages
+        self.heatmap = heatmap # (7, 24) messages per weekday (Monday first) and hour
+        self.cohort_sizes = cohort_sizes # (RETENTION_WEEKS,) members first seen N weeks ago
+        self.retention = retention # (RETENTION_WEEKS, RETENTION_WEEKS) share of cohort N active K weeks later
+
+def get_chat_report(chat_id, data_version):
+    """Returns the chat's report, recomputing it only if `data_version` changed since the last call."""
+    cached = _report_cache.get(chat_id)
+    if cached is not None and cached[0] == data_version:
+        return cached[1]
+    report = compute_chat_report(chat_id)
+    _report_cache[chat_id] = (data_version, report)
+    return report
+
+def compute_chat_report(chat_id):
+    # One bulk query per table, streamed straight into arrays
+    last_activity = np.fromiter(database.iter_chat_last_activity(chat_id), dtype=_LAST_ACTIVITY_DTYPE)
+    activity = np.fromiter(database.iter_chat_daily_activity(chat_id), dtype=_ACTIVITY_DTYPE)
+
+    days_silent = last_activity['days_ago']
+    member_count = len(days_silent)
+    active_count = int(np.count_nonzero(days_silent < ACTIVE_DAYS))
+    inactive_count = int(np.count_nonzero(days_silent >= INACTIVE_DAYS))
+
+    heatmap = np.zeros((7, 24), dtype=np.int64)
+    heatmap_rows = database.get_chat_heatmap(chat_id)
+    if heatmap_rows:
+        weekday, hour, count = np.array(heatmap_rows, dtype=np.int64).T
+        heatmap[weekday, hour] = count
+
+    cohort_sizes, retention = _retention(activity)
+    return ChatReport(
+        member_count, active_count, inactive_count, int(activity['count'].sum()),
+        heatmap, cohort_sizes, retention
+    )
+
+def _retention(activity):
+    """
+    Groups members by the week they were first seen (0 = this week) and, for each cohort,
+    computes the share that was active 0, 1, 2, ... weeks after that.
+    """
+    weeks = RETENTION_WEEKS
+    cohort_sizes = np.zeros(weeks, dtype=np.int64)
+    retention = np.zeros((weeks, weeks), dtype=np.float64)
+    if len(activity) == 0:
+        return cohort_sizes, retention
+
+    users, user_index = np.unique(activity['user_id'], return_inverse=True)
+    weeks_ago = activity['days_ago'] // 7
+
+    first_week = np.zeros(len(users), dtype=np.int64)
+    np.maximum.at(first_week, user_index, weeks_ago) # Oldest week each member was seen
+    cohort = first_week[user_index]
+    offset = cohort - weeks_ago # Weeks since the member's first week
+
+    in_range = (cohort < weeks) & (offset < weeks)
+    # Count each (member, week offset) once, however many days they were active in that week
+    keys = np.unique(user_index[in_range] * weeks + offset[in_range])
+    key_cohort = first_week[keys // weeks]
+    active = np.zeros((weeks, weeks), dtype=np.int64)
+    np.add.at(active, (key_cohort, keys % weeks), 1)
+
+    cohort_sizes = active[:, 0]
+    np.divide(active, cohort_sizes[:, None], out=retention, where=cohort_sizes[:, None] > 0)
+    return cohort_sizes, retention
+
+def _heatmap_text(heatmap):
+    peak = heatmap.max()
+    levels = np.zeros_like(heatmap) if peak == 0 else np.ceil(heatmap * (len(HEATMAP_SHADES) - 1) / peak).astype(np.int64)
+    rows = ["".join(row) for row in HEATMAP_SHADES[levels]]
+    header = "".join(str(h % 10) for h in range(24))
+    return "\n".join([header] + [f"{row} {name}" for row, name in zip(rows, WEEKDAY_NAMES)])
+
+def format_report(report, group_name):
+    """Formats a ChatReport as an HTML message. `group_name` must already be HTML-escaped."""
+    lines = [
+        f"<b>آمار فعالیت گروه {group_name}:</b>",
+        "",
+        f"اعضای ثبت‌شده: {report.member_count}",
+        f"فعال (در {ACTIVE_DAYS} روز اخیر): {report.active_count}",
+        f"غیرفعال (بیش از {INACTIVE_DAYS} روز): {report.inactive_count}",
+        f"پیام‌های ثبت‌شده در بازه روزانه: {report.total_messages}",
+    ]
+
+    by_weekday = report.heatmap.sum(axis=1)
+    by_hour = report.heatmap.sum(axis=0)
+    if by_hour.any():
+        lines.append(f"شلوغ‌ترین ساعت: {int(by_hour.argmax())}:00 | شلوغ‌ترین روز: {WEEKDAY_NAMES[int(by_weekday.argmax())]}")
+        lines += ["", "<b>نقشه فعالیت (ساعت × روز هفته):</b>", f"<pre>{_heatmap_text(report.heatmap)}</pre>"]
+
+    cohorts = np.flatnonzero(report.cohort_sizes)
+    if len(cohorts):
+        lines += ["", "<b>ماندگاری اعضای جدید (درصد فعال در هفته‌های بعد):</b>"]
+        for cohort in cohorts[::-1]: # Oldest cohort first
+            rates = report.retention[cohort, :cohort + 1]
+            rates_text = " ".join(f"{rate:.0%}" for rate in rates)
+            label = "این هفته" if cohort == 0 else f"{cohort} هفته پیش"
+            lines.append(f"{label} ({report.cohort_sizes[cohort]} نفر): {rates_text}")
+
+    return "\n".join(lines)
@@ -0,0 +1,50 @@
+import asyncio
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+class BackgroundJobs:
+    """
+    Periodic maintenance jobs that run next to the bot.
+
+    Jobs are plain asyncio tasks rather than application.create_task tasks, because
+    the application waits for those on shutdown and these loops never finish by
+    themselves. Blocking (non-async) jobs run in a worker thread so the database work
+    doesn't stall update handling.
+    """
+
+    def __init__(self):
+        self.jobs = [] # list of (name, interval seconds, first delay seconds, callable)
+        self.tasks = []
+
+    def every(self, interval, first=None, name=None):
+        """Decorator that registers a job to run every `interval` seconds (first run after `first`)."""
+        def decorator(func):
+            self.jobs.append((name or func.__name__, interval, interval if first is None else first, func))
+            return func
+        return decorator
+
+    async def _run(self, name, interval, first, func):
+        await asyncio.sleep(first)
+        while True:
+            try:
+                if inspect.iscoroutinefunction(func):
+                    await func()
+                else:
+                    await asyncio.to_thread(func)
+            except Exception as e:
+                logger.error(f"Background job '{name}' failed: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self):
+        if self.tasks:
+            return
+        for name, interval, first, func in self.jobs:
+            self.tasks.append(asyncio.create_task(self._run(name, interval, first, func), name=f"job:{name}"))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
@@ -0,0 +1,107 @@
+"""
+Compares the per-message cost of the old ORM user path with the UserCache path.
+
+For the update_user_stats path (load user, bump counters, write back) and the
+manage_group_links path (load user, read is_special), it reports the average
+transient memory allocated per message (tracemalloc peak above the baseline) and
+the time per message. The cache path flushes in batches like the bot does.
+
+Run with: python benchmark_user_cache.py [messages]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# The database file is relative to the working directory; keep the real one untouched
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="digitalbot_bench_"))
+
+import models
+from user_cache import UserCache
+
+USERS = 200
+FLUSH_EVERY = 100 # Roughly what a 10 s flush interval sees in a busy group
+
+def orm_stats_message(user_id):
+    session = models.Session()
+    try:
+        user = session.query(models.User).filter_by(id=user_id).first()
+        if not user:
+            user = models.User(id=user_id, username=f"user{user_id}", first_name="Name", last_name=None)
+            session.add(user)
+            session.commit()
+        now = datetime.now()
+        user.total_messages += 1
+        user.daily_messages += 1
+        user.hourly_messages += 1
+        user.weekly_messages += 1
+        user.monthly_messages += 1
+        user.last_message_time = now
+        session.commit()
+    finally:
+        session.close()
+
+def orm_link_message(user_id):
+    session = models.Session()
+    try:
+        user = session.query(models.User).filter_by(id=user_id).first()
+        return user.is_special
+    finally:
+        session.close()
+
+def make_cache_paths(cache):
+    def cache_stats_message(user_id):
+        user = cache.get_or_create(user_id, f"user{user_id}", "Name", None)
+        user.record_message(datetime.now())
+        cache.mark_dirty(user)
+
+    def cache_link_message(user_id):
+        return cache.get_or_create(user_id, f"user{user_id}", "Name", None).is_special
+
+    return cache_stats_message, cache_link_message
+
+def measure(func, messages, flush=None):
+    """Returns (average peak bytes allocated per message, microseconds per message)."""
+    peaks = 0
+    start = time.perf_counter()
+    tracemalloc.start()
+    for i in range(messages):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func(i % USERS)
+        if flush is not None and i % FLUSH_EVERY == FLUSH_EVERY - 1:
+            flush()
+        peaks += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    elapsed = time.perf_counter() - start
+    return peaks / messages, elapsed / messages * 1e6
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    models.init_schema()
+
+    cache = UserCache()
+    cache_stats_message, cache_link_message = make_cache_paths(cache)
+
+    # Warm up both paths so every user row exists and the cache is populated
+    for user_id in range(USERS):
+        orm_stats_message(user_id)
+        cache_stats_message(user_id)
+    cache.flush()
+
+    rows = [
+        ("update_user_stats", "ORM", measure(orm_stats_message, messages)),
+        ("update_user_stats", "UserCache", measure(cache_stats_message, messages, flush=cache.flush)),
+        ("manage_group_links", "ORM", measure(orm_link_message, messages)),
+        ("manage_group_links", "UserCache", measure(cache_link_message, messages)),
+    ]
+    print(f"{messages} messages over {USERS} users (time includes tracemalloc overhead)")
+    print(f"{'path':<20} {'storage':<10} {'bytes/msg':>12} {'us/msg':>10}")
+    for path, storage, (bytes_per_message, us_per_message) in rows:
+        print(f"{path:<20} {storage:<10} {bytes_per_message:>12,.0f} {us_per_message:>10,.1f}")
+
+if __name__ == "__main__":
+    main()
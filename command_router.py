@@ -0,0 +1,81 @@
+
+# Who may run a reply command
+ANYONE = 'anyone'
+ADMIN = 'admin'
+OWNER = 'owner'
+
+# Data a command can ask the router to prepare before it runs
+NEEDS_TARGET = 'target' # target user id and display name
+NEEDS_TARGET_DB = 'target_db' # target user's row in the users table
+NEEDS_SETTINGS = 'settings' # chat settings row
+
+# Invisible characters Persian keyboards insert (ZWNJ, ZWJ, direction marks, BOM) count as spaces,
+# and Arabic ye/kaf are folded into their Persian forms.
+_NORMALIZE_TABLE = str.maketrans({
+    '\u200c': ' ', '\u200d': ' ', '\u200e': ' ', '\u200f': ' ',
+    '\u2066': ' ', '\u2067': ' ', '\u2068': ' ', '\u2069': ' ', '\ufeff': ' ',
+    '\u064a': '\u06cc', '\u0649': '\u06cc', '\u0643': '\u06a9',
+})
+
+def normalize_text(text):
+    """Folds ZWNJ and Arabic letter variants and collapses whitespace."""
+    return " ".join(text.translate(_NORMALIZE_TABLE).split())
+
+class ReplyCommand:
+    """A keyword command triggered by replying to a message."""
+    __slots__ = ('keyword', 'handler', 'role', 'needs', 'takes_args', 'resolve_target')
+
+    def __init__(self, keyword, handler, role, needs, takes_args, resolve_target):
+        self.keyword = keyword
+        self.handler = handler
+        self.role = role
+        self.needs = frozenset(needs)
+        self.takes_args = takes_args
+        self.resolve_target = resolve_target
+
+    def __repr__(self):
+        return f"<ReplyCommand(keyword='{self.keyword}', role='{self.role}')>"
+
+class CommandMatch:
+    """Result of matching a message against the router: the command and its arguments."""
+    __slots__ = ('command', 'args')
+
+    def __init__(self, command, args):
+        self.command = command
+        self.args = args
+
+class CommandRouter:
+    """Keyword dispatch table for reply commands. Text is normalized and looked up once."""
+
+    def __init__(self):
+        self.commands = {} # normalized keyword -> ReplyCommand
+        self.max_words = 0
+
+    def register(self, keyword, handler, role=ANYONE, needs=(), takes_args=False, resolve_target=None):
+        key = normalize_text(keyword)
+        if key in self.commands:
+            raise ValueError(f"Reply command '{key}' is already registered")
+        self.commands[key] = ReplyCommand(key, handler, role, needs, takes_args, resolve_target)
+        self.max_words = max(self.max_words, len(key.split()))
+
+    def command(self, keyword, **options):
+        """Decorator form of register()."""
+        def decorator(handler):
+            self.register(keyword, handler, **options)
+            return handler
+        return decorator
+
+    def match(self, text):
+        """Returns a CommandMatch for the longest keyword prefix of `text`, or None."""
+        if not text:
+            return None
+        words = normalize_text(text).split(" ")
+        for length in range(min(self.max_words, len(words)), 0, -1):
+            command = self.commands.get(" ".join(words[:length]))
+            if command is None:
+                continue
+            args = words[length:]
+            if args and not command.takes_args:
+                return None # Keyword commands without arguments must match exactly
+            return CommandMatch(command, args)
+        return None
@@ -1,10 +1,12 @@
 import sqlite3
 import json
 import datetime
+import time
 
 DATABASE_NAME = 'digitalbot.db'
 
 def init_db():
+    # Called from models.init_schema() when the schema version changes, not on import
     conn = sqlite3.connect(DATABASE_NAME)
     cursor = conn.cursor()
 
@@ -40,6 +42,88 @@ def init_db():
             PRIMARY KEY (chat_id, user_id, activity_date)
         )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_activity_date ON daily_activity (activity_date)')
+
+    # Rolled-up activity. Old daily_activity rows are summed into weeks (starting Monday),
+    # and old weeks into months (a week counts toward the month it starts in).
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS weekly_activity (
+            chat_id INTEGER,
+            user_id INTEGER,
+            week_start TEXT, -- YYYY-MM-DD (Monday)
+            message_count INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id, week_start)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_weekly_activity_week ON weekly_activity (week_start)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_activity (
+            chat_id INTEGER,
+            user_id INTEGER,
+            month_start TEXT, -- YYYY-MM-01
+            message_count INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id, month_start)
+        )
+    ''')
+
+    # Messages per (weekday, hour) for each chat, for activity heatmaps. At most 168 rows per chat.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_activity_heatmap (
+            chat_id INTEGER,
+            weekday INTEGER, -- 0 = Monday
+            hour INTEGER,
+            message_count INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, weekday, hour)
+        )
+    ''')
+
+    # Per-chat warning ledger. One row per (chat, user); the count is reset when the
+    # previous warning has expired. expires_at is a unix timestamp.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_warnings (
+            chat_id INTEGER,
+            user_id INTEGER,
+            warning_count INTEGER DEFAULT 0,
+            expires_at INTEGER,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_warnings_expires_at ON chat_warnings (expires_at)')
+
+    # Latest join time of each member, for bulk moderation of recent joiners (e.g. after a raid).
+    # joined_at is a unix timestamp; rows are pruned after a few days.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_joins (
+            chat_id INTEGER,
+            user_id INTEGER,
+            joined_at INTEGER,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_joins_chat_time ON chat_joins (chat_id, joined_at)')
+
+    # Bulk ban/unban/mute jobs and the state of every user in them, so a job that partly
+    # failed (or was interrupted) can be resumed without repeating finished users.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS moderation_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            action TEXT, -- 'ban', 'unban', 'mute'
+            duration_seconds INTEGER, -- mute length
+            created_by INTEGER,
+            created_at INTEGER
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_moderation_jobs_created_at ON moderation_jobs (created_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS moderation_job_items (
+            job_id INTEGER,
+            user_id INTEGER,
+            status TEXT DEFAULT 'pending', -- 'pending', 'done', 'failed'
+            error TEXT,
+            PRIMARY KEY (job_id, user_id)
+        )
+    ''')
 
     conn.commit()
     conn.close()
@@ -66,7 +150,8 @@ def update_user_stats(chat_id, user_id, username, full_name):
     conn = sqlite3.connect(DATABASE_NAME)
     cursor = conn.cursor()
     
-    today = datetime.date.today().isoformat() # YYYY-MM-DD
+    now = datetime.datetime.now()
+    today = now.date().isoformat() # YYYY-MM-DD
     
     # Update main user_stats table
     cursor.execute('''
@@ -95,6 +180,14 @@ def update_user_stats(chat_id, user_id, username, full_name):
         WHERE chat_id = ? AND user_id = ? AND activity_date = ?
     ''', (chat_id, user_id, today))
 
+    # Update chat_activity_heatmap table
+    cursor.execute('''
+        INSERT INTO chat_activity_heatmap (chat_id, weekday, hour, message_count)
+        VALUES (?, ?, ?, 1)
+        ON CONFLICT (chat_id, weekday, hour) DO UPDATE
+        SET message_count = message_count + 1
+    ''', (chat_id, now.weekday(), now.hour))
+
     conn.commit()
     conn.close()
 
@@ -112,18 +205,475 @@ def get_all_user_stats(chat_id):
     return results
 
 def get_user_daily_activity(chat_id, user_id):
+    """
+    Returns (period_start, message_count) rows, newest first, across all activity tiers.
+    Recent periods are single days; older ones are the weeks and months they were rolled
+    up into by compact_activity(), keyed by their first day. Use get_user_activity_history()
+    to also see each row's granularity.
+    """
+    return [(period_start, count) for period_start, _, count in get_user_activity_history(chat_id, user_id)]
+
+def add_warning(chat_id, user_id, expiry_seconds):
+    """
+    Atomically adds a warning for a user in a chat and returns their current warning count.
+    Warnings older than `expiry_seconds` (counted from the latest warning) no longer count.
+    Needs SQLite 3.35+ for RETURNING.
+    """
     conn = sqlite3.connect(DATABASE_NAME)
     cursor = conn.cursor()
+    now = int(time.time())
     cursor.execute('''
-        SELECT activity_date, message_count_day
-        FROM daily_activity
+        INSERT INTO chat_warnings (chat_id, user_id, warning_count, expires_at)
+        VALUES (?, ?, 1, ?)
+        ON CONFLICT (chat_id, user_id) DO UPDATE
+        SET warning_count = CASE WHEN expires_at <= ? THEN 1 ELSE warning_count + 1 END,
+            expires_at = excluded.expires_at
+        RETURNING warning_count
+    ''', (chat_id, user_id, now + expiry_seconds, now))
+    warning_count = cursor.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return warning_count
+
+def reset_warnings(chat_id, user_id):
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM chat_warnings WHERE chat_id = ? AND user_id = ?', (chat_id, user_id))
+    conn.commit()
+    conn.close()
+
+def prune_expired_warnings():
+    """Deletes expired warnings (uses the expires_at index). Returns the number of rows removed."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM chat_warnings WHERE expires_at <= ?', (int(time.time()),))
+    deleted = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+def iter_chat_daily_activity(chat_id):
+    """
+    Streams (user_id, days_ago, message_count) for every raw daily_activity row of a chat.
+    days_ago is 0 for today; computing it in SQL lets callers build arrays without parsing dates.
+    """
+    conn = sqlite3.connect(DATABASE_NAME)
+    try:
+        cursor = conn.execute('''
+            SELECT user_id,
+                   CAST(julianday(date('now', 'localtime')) - julianday(activity_date) AS INTEGER),
+                   message_count_day
+            FROM daily_activity
+            WHERE chat_id = ?
+        ''', (chat_id,))
+        yield from cursor
+    finally:
+        conn.close()
+
+def iter_chat_last_activity(chat_id):
+    """Streams (user_id, days_since_last_activity) for every known member of a chat."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    try:
+        cursor = conn.execute('''
+            SELECT user_id,
+                   CAST(julianday(date('now', 'localtime')) - julianday(last_activity) AS INTEGER)
+            FROM user_stats
+            WHERE chat_id = ?
+        ''', (chat_id,))
+        yield from cursor
+    finally:
+        conn.close()
+
+def get_chat_heatmap(chat_id):
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute('SELECT weekday, hour, message_count FROM chat_activity_heatmap WHERE chat_id = ?', (chat_id,))
+    results = cursor.fetchall()
+    conn.close()
+    return results
+
+def get_user_activity_history(chat_id, user_id):
+    """
+    Returns a user's full activity history across the raw and rolled-up tiers as
+    (period_start, granularity, message_count) rows, newest first.
+    granularity is 'day', 'week' or 'month'; the tiers never overlap.
+    """
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT activity_date, 'day', message_count_day FROM daily_activity
+        WHERE chat_id = ? AND user_id = ?
+        UNION ALL
+        SELECT week_start, 'week', message_count FROM weekly_activity
         WHERE chat_id = ? AND user_id = ?
-        ORDER BY activity_date DESC
-    ''', (chat_id, user_id))
+        UNION ALL
+        SELECT month_start, 'month', message_count FROM monthly_activity
+        WHERE chat_id = ? AND user_id = ?
+        ORDER BY 1 DESC
+    ''', (chat_id, user_id) * 3)
     results = cursor.fetchall()
     conn.close()
     return results
 
-# Initialize the database when this module is imported
-init_db()
+def compact_activity(daily_retention_days, weekly_retention_days, max_slices=12):
+    """
+    Rolls daily_activity rows older than `daily_retention_days` into weekly_activity and
+    weekly rows older than `weekly_retention_days` into monthly_activity, deleting the rolled
+    rows. Cutoffs are aligned to week/month boundaries so a period is never split across tiers.
+
+    Work is done one week (or month) per transaction, oldest first, and at most `max_slices`
+    slices per tier per call to keep write locks short. Returns (days_rolled, weeks_rolled)
+    as row counts removed from the finer tiers.
+    """
+    today = datetime.date.today()
+    daily_cutoff = today - datetime.timedelta(days=daily_retention_days)
+    daily_cutoff -= datetime.timedelta(days=daily_cutoff.weekday()) # Monday
+    weekly_cutoff = (today - datetime.timedelta(days=weekly_retention_days)).replace(day=1)
+
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    days_rolled = 0
+    weeks_rolled = 0
+    try:
+        for _ in range(max_slices):
+            cursor.execute('SELECT MIN(activity_date) FROM daily_activity WHERE activity_date < ?', (daily_cutoff.isoformat(),))
+            oldest = cursor.fetchone()[0]
+            if oldest is None:
+                break
+            week_start = datetime.date.fromisoformat(oldest)
+            week_start -= datetime.timedelta(days=week_start.weekday())
+            week_end = week_start + datetime.timedelta(days=7)
+            cursor.execute('''
+                INSERT INTO weekly_activity (chat_id, user_id, week_start, message_count)
+                SELECT chat_id, user_id, ?, SUM(message_count_day)
+                FROM daily_activity
+                WHERE activity_date >= ? AND activity_date < ?
+                GROUP BY chat_id, user_id
+                ON CONFLICT (chat_id, user_id, week_start) DO UPDATE
+                SET message_count = message_count + excluded.message_count
+            ''', (week_start.isoformat(), week_start.isoformat(), week_end.isoformat()))
+            cursor.execute('DELETE FROM daily_activity WHERE activity_date >= ? AND activity_date < ?',
+                           (week_start.isoformat(), week_end.isoformat()))
+            days_rolled += cursor.rowcount
+            conn.commit()
+
+        for _ in range(max_slices):
+            cursor.execute('SELECT MIN(week_start) FROM weekly_activity WHERE week_start < ?', (weekly_cutoff.isoformat(),))
+            oldest = cursor.fetchone()[0]
+            if oldest is None:
+                break
+            month_start = datetime.date.fromisoformat(oldest).replace(day=1)
+            month_end = (month_start + datetime.timedelta(days=32)).replace(day=1)
+            cursor.execute('''
+                INSERT INTO monthly_activity (chat_id, user_id, month_start, message_count)
+                SELECT chat_id, user_id, ?, SUM(message_count)
+                FROM weekly_activity
+                WHERE week_start >= ? AND week_start < ?
+                GROUP BY chat_id, user_id
+                ON CONFLICT (chat_id, user_id, month_start) DO UPDATE
+                SET message_count = message_count + excluded.message_count
+            ''', (month_start.isoformat(), month_start.isoformat(), month_end.isoformat()))
+            cursor.execute('DELETE FROM weekly_activity WHERE week_start >= ? AND week_start < ?',
+                           (month_start.isoformat(), month_end.isoformat()))
+            weeks_rolled += cursor.rowcount
+            conn.commit()
+    finally:
+        conn.close()
+    return days_rolled, weeks_rolled
+
+# Queries used by stats_export; each yields (user_id, ...) rows of one chat.
+EXPORT_QUERIES = {
+    'members': (
+        ('user_id', 'username', 'full_name', 'message_count', 'last_activity'),
+        '''
+            SELECT user_id, username, full_name, message_count, last_activity
+            FROM user_stats
+            WHERE chat_id = ?
+            ORDER BY message_count DESC
+        ''',
+    ),
+    'activity': (
+        ('user_id', 'period_start', 'granularity', 'message_count'),
+        '''
+            SELECT user_id, activity_date, 'day', message_count_day FROM daily_activity WHERE chat_id = ?1
+            UNION ALL
+            SELECT user_id, week_start, 'week', message_count FROM weekly_activity WHERE chat_id = ?1
+            UNION ALL
+            SELECT user_id, month_start, 'month', message_count FROM monthly_activity WHERE chat_id = ?1
+        ''',
+    ),
+}
+
+def iter_export_chunks(name, chat_id, chunk_size=5000):
+    """
+    Streams the rows of EXPORT_QUERIES[name] for a chat in lists of at most `chunk_size`.
+    SQLite steps the cursor lazily, so only one chunk is held in memory at a time.
+    """
+    _, query = EXPORT_QUERIES[name]
+    conn = sqlite3.connect(DATABASE_NAME)
+    try:
+        cursor = conn.execute(query, (chat_id,))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+# --- users table (created by models.py) ---
+# Plain-row access for user_cache. Datetimes use SQLAlchemy's SQLite storage format so the
+# ORM keeps reading these rows.
+
+USER_COLUMNS = (
+    'id', 'username', 'first_name', 'last_name',
+    'total_messages', 'daily_messages', 'hourly_messages', 'weekly_messages', 'monthly_messages',
+    'last_message_time', 'is_special',
+)
+USER_COUNTER_COLUMNS = USER_COLUMNS[1:] # Everything but the primary key
+
+def format_db_datetime(value):
+    # Not strftime: it doesn't zero-pad years before 1000 (datetime.min is the column default)
+    return (f"{value.year:04d}-{value.month:02d}-{value.day:02d} "
+            f"{value.hour:02d}:{value.minute:02d}:{value.second:02d}.{value.microsecond:06d}")
+
+def parse_db_datetime(value):
+    return datetime.datetime.fromisoformat(value) if value else datetime.datetime.min
+
+def load_user(user_id):
+    """Returns the users row as a tuple in USER_COLUMNS order, or None."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT {", ".join(USER_COLUMNS)} FROM users WHERE id = ?', (user_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return result
+
+def insert_user(user_id, username, first_name, last_name):
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT OR IGNORE INTO users (id, username, first_name, last_name,
+            total_messages, daily_messages, hourly_messages, weekly_messages, monthly_messages,
+            last_message_time, warnings, is_special)
+        VALUES (?, ?, ?, ?, 0, 0, 0, 0, 0, ?, 0, 0)
+    ''', (user_id, username, first_name or "", last_name, format_db_datetime(datetime.datetime.min)))
+    conn.commit()
+    conn.close()
+
+def update_users(rows):
+    """Writes many users at once. `rows` are tuples of USER_COUNTER_COLUMNS values followed by the id."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    assignments = ", ".join(f"{column} = ?" for column in USER_COUNTER_COLUMNS)
+    cursor.executemany(f'UPDATE users SET {assignments} WHERE id = ?', rows)
+    conn.commit()
+    conn.close()
+
+# Join records and bulk moderation jobs
+
+def record_joins(chat_id, user_ids, joined_at=None):
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    joined_at = int(time.time()) if joined_at is None else joined_at
+    cursor.executemany('''
+        INSERT INTO chat_joins (chat_id, user_id, joined_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT (chat_id, user_id) DO UPDATE
+        SET joined_at = excluded.joined_at
+    ''', [(chat_id, user_id, joined_at) for user_id in user_ids])
+    conn.commit()
+    conn.close()
+
+def get_recent_joins(chat_id, since):
+    """User ids that joined the chat at or after the unix timestamp `since`, oldest first."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT user_id FROM chat_joins
+        WHERE chat_id = ? AND joined_at >= ?
+        ORDER BY joined_at
+    ''', (chat_id, since))
+    results = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return results
+
+def create_moderation_job(chat_id, action, user_ids, created_by, duration_seconds=None):
+    """Stores a bulk job with every user pending and returns its id."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO moderation_jobs (chat_id, action, duration_seconds, created_by, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (chat_id, action, duration_seconds, created_by, int(time.time())))
+    job_id = cursor.lastrowid
+    cursor.executemany(
+        'INSERT OR IGNORE INTO moderation_job_items (job_id, user_id) VALUES (?, ?)',
+        [(job_id, user_id) for user_id in user_ids]
+    )
+    conn.commit()
+    conn.close()
+    return job_id
+
+def get_moderation_job(job_id):
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute('SELECT chat_id, action, duration_seconds FROM moderation_jobs WHERE job_id = ?', (job_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return result # (chat_id, action, duration_seconds) or None
+
+def get_unfinished_moderation_items(job_id):
+    """User ids of the job that are still pending or failed last time."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT user_id FROM moderation_job_items WHERE job_id = ? AND status != 'done'",
+        (job_id,)
+    )
+    results = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return results
 
+def set_moderation_item_results(job_id, rows):
+    """`rows` are (status, error, user_id) tuples."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.executemany(
+        'UPDATE moderation_job_items SET status = ?, error = ? WHERE job_id = ? AND user_id = ?',
+        [(status, error, job_id, user_id) for status, error, user_id in rows]
+    )
+    conn.commit()
+    conn.close()
+
+def get_moderation_job_summary(job_id, max_errors=5):
+    """Returns ({status: user count}, [(user_id, error), ...] for up to `max_errors` failed users)."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT status, COUNT(*) FROM moderation_job_items WHERE job_id = ? GROUP BY status',
+        (job_id,)
+    )
+    counts = dict(cursor.fetchall())
+    cursor.execute(
+        "SELECT user_id, error FROM moderation_job_items WHERE job_id = ? AND status = 'failed' LIMIT ?",
+        (job_id, max_errors)
+    )
+    errors = cursor.fetchall()
+    conn.close()
+    return counts, errors
+
+def prune_moderation_records(joins_before, jobs_before):
+    """Deletes join records and bulk jobs older than the given unix timestamps. Returns (joins, jobs) removed."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM chat_joins WHERE joined_at < ?', (joins_before,))
+    joins_deleted = cursor.rowcount
+    cursor.execute('''
+        DELETE FROM moderation_job_items
+        WHERE job_id IN (SELECT job_id FROM moderation_jobs WHERE created_at < ?)
+    ''', (jobs_before,))
+    cursor.execute('DELETE FROM moderation_jobs WHERE created_at < ?', (jobs_before,))
+    jobs_deleted = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return joins_deleted, jobs_deleted
+
+# Storage maintenance (scheduled by db_maintenance.py)
+
+def configure_storage():
+    """
+    Switches the file to WAL, so readers don't wait for writers, and asks for incremental
+    auto-vacuum so free pages can be returned in small steps. auto_vacuum only takes effect
+    on a new database or after a full VACUUM (see enable_incremental_vacuum()).
+    """
+    conn = sqlite3.connect(DATABASE_NAME)
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('PRAGMA journal_mode = WAL') # Persistent, stored in the file
+    conn.close()
+
+def get_storage_info():
+    """Returns page_size, page_count, freelist_count, auto_vacuum (0 none, 1 full, 2 incremental) and journal_mode."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    info = {}
+    for pragma in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum', 'journal_mode'):
+        cursor.execute(f'PRAGMA {pragma}')
+        info[pragma] = cursor.fetchone()[0]
+    conn.close()
+    return info
+
+def checkpoint_wal(mode='PASSIVE'):
+    """
+    Copies WAL frames back into the database. PASSIVE never waits for other connections;
+    TRUNCATE also resets the -wal file to zero bytes once no reader needs it.
+    Returns (busy, wal_frames, checkpointed_frames).
+    """
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute(f'PRAGMA wal_checkpoint({mode})')
+    result = cursor.fetchone()
+    conn.close()
+    return result
+
+def optimize_db():
+    """Runs a full ANALYZE the first time, then PRAGMA optimize (which only re-analyzes tables that need it)."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_schema WHERE name = 'sqlite_stat1'")
+    if cursor.fetchone() is None:
+        cursor.execute('ANALYZE')
+        step = 'analyze'
+    else:
+        cursor.execute('PRAGMA optimize')
+        step = 'optimize'
+    conn.commit()
+    conn.close()
+    return step
+
+def incremental_vacuum(pages):
+    """Returns up to `pages` free pages to the file system in one short transaction. Returns the pages freed."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA freelist_count')
+    before = cursor.fetchone()[0]
+    # executescript steps the pragma to completion; execute() would stop after the first page
+    cursor.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+    cursor.execute('PRAGMA freelist_count')
+    after = cursor.fetchone()[0]
+    conn.close()
+    return before - after
+
+def enable_incremental_vacuum():
+    """One-time conversion of an existing database to incremental auto-vacuum. Rewrites the whole file."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    conn.close()
+
+def get_table_stats():
+    """
+    Returns {table: (row_count, bytes)}. Bytes include the table's indexes and are None if
+    SQLite was built without the dbstat table. Row counts scan each table, so this is meant
+    for quiet periods.
+    """
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_schema WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    tables = [row[0] for row in cursor.fetchall()]
+    sizes = {}
+    try:
+        cursor.execute('''
+            SELECT s.tbl_name, SUM(d.pgsize)
+            FROM dbstat AS d JOIN sqlite_schema AS s ON s.name = d.name
+            GROUP BY s.tbl_name
+        ''')
+        sizes = dict(cursor.fetchall())
+    except sqlite3.OperationalError:
+        sizes = None
+    stats = {}
+    for table in tables:
+        cursor.execute(f'SELECT COUNT(*) FROM "{table}"')
+        stats[table] = (cursor.fetchone()[0], sizes.get(table, 0) if sizes is not None else None)
+    conn.close()
+    return stats
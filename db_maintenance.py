@@ -0,0 +1,207 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import database
+
+logger = logging.getLogger(__name__)
+
+class TrafficMonitor:
+    """Counts handled messages per minute over a sliding window, to find quiet moments for maintenance."""
+
+    def __init__(self, window_minutes=10):
+        self.window_minutes = window_minutes
+        self._buckets = deque() # [minute, count], oldest first
+        self._lock = threading.Lock() # Recorded on the event loop, read from the maintenance thread
+
+    def record(self, count=1):
+        minute = int(time.time() // 60)
+        with self._lock:
+            if self._buckets and self._buckets[-1][0] == minute:
+                self._buckets[-1][1] += count
+            else:
+                self._buckets.append([minute, count])
+                while self._buckets and self._buckets[0][0] <= minute - self.window_minutes:
+                    self._buckets.popleft()
+
+    def per_minute(self):
+        minute = int(time.time() // 60)
+        with self._lock:
+            total = sum(count for bucket_minute, count in self._buckets if bucket_minute > minute - self.window_minutes)
+        return total / self.window_minutes
+
+class MaintenanceMetrics:
+    """Latest maintenance results, served in Prometheus text format by the health server's /metrics route."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.steps = {} # step -> [last duration seconds, total seconds, runs, last run unix time]
+        self.tables = {} # table -> (rows, bytes or None)
+        self.storage = {} # database.get_storage_info()
+        self.skipped_runs = 0 # Runs that only did a passive checkpoint because the bot was busy
+        self.pages_vacuumed = 0
+        self.tables_collected_at = 0.0
+
+    def record_step(self, step, seconds):
+        with self._lock:
+            entry = self.steps.setdefault(step, [0.0, 0.0, 0, 0.0])
+            entry[0] = seconds
+            entry[1] += seconds
+            entry[2] += 1
+            entry[3] = time.time()
+
+    def set_tables(self, tables):
+        with self._lock:
+            self.tables = tables
+            self.tables_collected_at = time.time()
+
+    def set_storage(self, storage):
+        with self._lock:
+            self.storage = storage
+
+    def add(self, skipped_runs=0, pages_vacuumed=0):
+        with self._lock:
+            self.skipped_runs += skipped_runs
+            self.pages_vacuumed += pages_vacuumed
+
+    def to_prometheus(self):
+        def metric(lines, name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = "{" + ",".join(f'{key}="{val}"' for key, val in labels.items()) + "}" if labels else ""
+                lines.append(f"{name}{label_text} {value}")
+
+        with self._lock:
+            steps = {step: list(entry) for step, entry in self.steps.items()}
+            tables = dict(self.tables)
+            storage = dict(self.storage)
+            skipped_runs, pages_vacuumed = self.skipped_runs, self.pages_vacuumed
+
+        files = []
+        for label, path in (('db', database.DATABASE_NAME), ('wal', database.DATABASE_NAME + '-wal')):
+            try:
+                files.append(({'file': label}, os.path.getsize(path)))
+            except OSError:
+                files.append(({'file': label}, 0))
+
+        lines = []
+        metric(lines, 'digitalbot_db_file_bytes', 'gauge', "Size of the database and WAL files.", files)
+        metric(lines, 'digitalbot_db_table_rows', 'gauge', "Rows per table, counted during the last maintenance run.",
+               [({'table': table}, rows) for table, (rows, _) in sorted(tables.items())])
+        metric(lines, 'digitalbot_db_table_bytes', 'gauge', "Bytes used by each table and its indexes.",
+               [({'table': table}, size) for table, (_, size) in sorted(tables.items()) if size is not None])
+        if storage:
+            metric(lines, 'digitalbot_db_pages', 'gauge', "Pages in the database file, and free pages not yet vacuumed.",
+                   [({'kind': 'total'}, storage['page_count']), ({'kind': 'free'}, storage['freelist_count'])])
+            metric(lines, 'digitalbot_db_page_size_bytes', 'gauge', "SQLite page size.", [({}, storage['page_size'])])
+        metric(lines, 'digitalbot_db_maintenance_last_duration_seconds', 'gauge', "Duration of the latest run of each maintenance step.",
+               [({'step': step}, f"{entry[0]:.6f}") for step, entry in sorted(steps.items())])
+        metric(lines, 'digitalbot_db_maintenance_duration_seconds_total', 'counter', "Total time spent in each maintenance step.",
+               [({'step': step}, f"{entry[1]:.6f}") for step, entry in sorted(steps.items())])
+        metric(lines, 'digitalbot_db_maintenance_runs_total', 'counter', "Completed runs of each maintenance step.",
+               [({'step': step}, entry[2]) for step, entry in sorted(steps.items())])
+        metric(lines, 'digitalbot_db_maintenance_last_run_timestamp_seconds', 'gauge', "Unix time of the latest run of each step.",
+               [({'step': step}, f"{entry[3]:.0f}") for step, entry in sorted(steps.items())])
+        metric(lines, 'digitalbot_db_maintenance_skipped_runs_total', 'counter', "Maintenance runs deferred because the bot was busy.",
+               [({}, skipped_runs)])
+        metric(lines, 'digitalbot_db_vacuumed_pages_total', 'counter', "Free pages returned to the file system by incremental vacuum.",
+               [({}, pages_vacuumed)])
+        return "\n".join(lines) + "\n"
+
+metrics = MaintenanceMetrics()
+
+class DatabaseMaintenance:
+    """
+    Keeps the SQLite file healthy without getting in the way of message handling.
+
+    Every run does a passive WAL checkpoint, which never blocks anyone. The heavier work
+    only happens while traffic is below `quiet_messages_per_minute`:
+    - a TRUNCATE checkpoint to shrink the -wal file,
+    - PRAGMA optimize (a full ANALYZE the first time),
+    - incremental vacuum in slices of `vacuum_slice_pages`, pausing between slices and
+      stopping after `vacuum_seconds` or as soon as traffic picks up,
+    - row counts and sizes for every table, at most every `stats_interval` seconds
+      (or after `stats_max_age` seconds even if it is never quiet).
+    Databases created before incremental auto-vacuum are converted once with a full VACUUM
+    only if they are smaller than `convert_max_bytes`: the VACUUM holds the write lock for
+    as long as it takes to rewrite the file, so it must stay well below sqlite3's 5 s busy
+    timeout. Larger files are left for the operator to convert during downtime.
+    """
+
+    def __init__(self, traffic, quiet_messages_per_minute=5, vacuum_slice_pages=256, vacuum_seconds=2.0,
+                 slice_pause=0.05, stats_interval=60 * 60, stats_max_age=6 * 60 * 60,
+                 convert_max_bytes=4 * 1024 * 1024):
+        self.traffic = traffic
+        self.quiet_messages_per_minute = quiet_messages_per_minute
+        self.vacuum_slice_pages = vacuum_slice_pages
+        self.vacuum_seconds = vacuum_seconds
+        self.slice_pause = slice_pause
+        self.stats_interval = stats_interval
+        self.stats_max_age = stats_max_age
+        self.convert_max_bytes = convert_max_bytes
+        self._conversion_declined = False
+
+    def is_quiet(self):
+        return self.traffic.per_minute() < self.quiet_messages_per_minute
+
+    def _timed(self, step, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        metrics.record_step(step, time.perf_counter() - start)
+        return result
+
+    def _vacuum_slices(self):
+        deadline = time.monotonic() + self.vacuum_seconds
+        freed = 0
+        while time.monotonic() < deadline and self.is_quiet():
+            pages = database.incremental_vacuum(self.vacuum_slice_pages)
+            freed += pages
+            if pages < self.vacuum_slice_pages:
+                break # Free list is empty
+            time.sleep(self.slice_pause) # Let waiting writers in between slices
+        return freed
+
+    def _maybe_convert(self, storage):
+        if storage['auto_vacuum'] == 2 or self._conversion_declined:
+            return False
+        size = storage['page_count'] * storage['page_size']
+        if size > self.convert_max_bytes:
+            self._conversion_declined = True
+            logger.warning(
+                f"Database is {size / (1024 * 1024):.0f} MB and has no incremental auto-vacuum; "
+                "stop the bot and run 'PRAGMA auto_vacuum = INCREMENTAL; VACUUM;' on it to enable it "
+                "(or raise DB_VACUUM_CONVERT_MAX_MB to let maintenance convert it while the bot runs)."
+            )
+            return False
+        logger.info("Converting the database to incremental auto-vacuum (one-time full VACUUM)...")
+        self._timed('vacuum', database.enable_incremental_vacuum)
+        return True
+
+    def run(self):
+        """One maintenance pass. Blocking; run it in a worker thread."""
+        run_start = time.perf_counter()
+        storage = database.get_storage_info()
+        if storage['journal_mode'] == 'wal':
+            self._timed('checkpoint_passive', database.checkpoint_wal, 'PASSIVE')
+
+        quiet = self.is_quiet()
+        stats_age = time.time() - metrics.tables_collected_at
+        if quiet:
+            if storage['journal_mode'] == 'wal':
+                self._timed('checkpoint_truncate', database.checkpoint_wal, 'TRUNCATE')
+            self._timed('optimize', database.optimize_db)
+            if self._maybe_convert(storage):
+                storage = database.get_storage_info()
+            if storage['auto_vacuum'] == 2 and storage['freelist_count']:
+                freed = self._timed('incremental_vacuum', self._vacuum_slices)
+                metrics.add(pages_vacuumed=freed)
+        else:
+            metrics.add(skipped_runs=1)
+
+        if (quiet and stats_age >= self.stats_interval) or stats_age >= self.stats_max_age:
+            metrics.set_tables(self._timed('table_stats', database.get_table_stats))
+        metrics.set_storage(database.get_storage_info())
+        metrics.record_step('total', time.perf_counter() - run_start)
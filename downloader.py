@@ -0,0 +1,376 @@
+import asyncio
+import contextlib
+import logging
+import os
+from collections import OrderedDict
+
+from telegram import InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest, RetryAfter
+
+from supervisor import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTS = ('mp4', 'webm', 'avi', 'mkv', 'mov')
+PHOTO_EXTS = ('jpg', 'jpeg', 'png', 'gif', 'webp')
+AUDIO_EXTS = ('mp3', 'wav', 'ogg', 'flac')
+
+# Telegram accepts 2-10 items per media group
+MEDIA_GROUP_LIMIT = 10
+
+_INPUT_MEDIA = {
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+    'audio': InputMediaAudio,
+    'document': InputMediaDocument,
+}
+# Photos and videos can share a group; audio and documents only go with their own kind
+_GROUP_CLASS = {'photo': 'visual', 'video': 'visual', 'audio': 'audio', 'document': 'document'}
+
+def media_kind(ext):
+    ext = (ext or "").lower()
+    if ext in VIDEO_EXTS:
+        return 'video'
+    if ext in PHOTO_EXTS:
+        return 'photo'
+    if ext in AUDIO_EXTS:
+        return 'audio'
+    return 'document'
+
+def media_key(info):
+    """Identifies a downloaded item across requests, e.g. "Instagram:3141592653"."""
+    if info.get('id'):
+        return f"{info.get('extractor_key') or info.get('ie_key') or ''}:{info['id']}"
+    return info.get('webpage_url') or info.get('url')
+
+class MediaItem:
+    """One file of a download job: either a freshly downloaded `path` or a cached Telegram `file_id`."""
+    __slots__ = ('key', 'kind', 'path', 'file_id')
+
+    def __init__(self, key, kind, path=None, file_id=None):
+        self.key = key
+        self.kind = kind
+        self.path = path
+        self.file_id = file_id
+
+class DownloadBudget:
+    """
+    Limits all downloads in the process to `max_concurrency` fetches at a time and
+    `max_bytes` of files on disk. A job reserves its estimated size up front, in one
+    step so jobs can't deadlock holding half of what they need, and keeps it until its
+    files are sent and deleted.
+
+    Both waits take an optional `job` (any object identifying the download job) and
+    `on_queue(position)` callback, called with the job's 1-based place among waiting
+    jobs whenever it changes and with None once the job is let through.
+    """
+
+    def __init__(self, max_concurrency=3, max_bytes=200 * 1024 * 1024):
+        self.max_concurrency = max_concurrency
+        self.max_bytes = max_bytes
+        self.bytes_reserved = 0
+        self.active_fetches = 0
+        self._waiting = [] # Jobs waiting for bytes or a fetch slot, oldest first; a job can appear more than once
+        self._condition = None
+
+    def _get_condition(self):
+        # Created lazily so it binds to the running event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def queue_position(self, job):
+        """1-based place of `job` among distinct waiting jobs, or None if it isn't waiting."""
+        ahead = []
+        for waiter in self._waiting:
+            if waiter is job:
+                return len(ahead) + 1
+            if not any(waiter is other for other in ahead):
+                ahead.append(waiter)
+        return None
+
+    async def _wait(self, condition, admitted, job, on_queue):
+        """Waits (holding `condition`) until `admitted()`, reporting the job's queue position meanwhile."""
+        if admitted():
+            return
+        job = job if job is not None else object()
+        self._waiting.append(job)
+        try:
+            while not admitted():
+                if on_queue is not None:
+                    on_queue(self.queue_position(job))
+                await condition.wait()
+        finally:
+            self._waiting.remove(job)
+            condition.notify_all() # Jobs behind this one moved up
+        if on_queue is not None:
+            on_queue(self.queue_position(job)) # None unless other items of the same job still wait
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, nbytes, job=None, on_queue=None):
+        condition = self._get_condition()
+        nbytes = min(nbytes, self.max_bytes) # A job larger than the whole budget waits for exclusive use
+        async with condition:
+            await self._wait(condition, lambda: self.bytes_reserved + nbytes <= self.max_bytes, job, on_queue)
+            self.bytes_reserved += nbytes
+        try:
+            yield
+        finally:
+            async with condition:
+                self.bytes_reserved -= nbytes
+                condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, job=None, on_queue=None):
+        """Held while a file is being fetched."""
+        condition = self._get_condition()
+        async with condition:
+            await self._wait(condition, lambda: self.active_fetches < self.max_concurrency, job, on_queue)
+            self.active_fetches += 1
+        try:
+            yield
+        finally:
+            async with condition:
+                self.active_fetches -= 1
+                condition.notify_all()
+
+class FileIdCache:
+    """LRU map of media_key -> (kind, file_id), so repeated links are re-sent without downloading."""
+
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, kind, file_id):
+        if key is None or file_id is None:
+            return
+        self._entries[key] = (kind, file_id)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+def split_media_groups(items):
+    """
+    Splits items into sendable groups of at most MEDIA_GROUP_LIMIT, keeping kinds that
+    can't be mixed apart. Groups of a kind are balanced (11 items -> 6 + 5) so a lone
+    leftover item doesn't have to be sent on its own.
+    """
+    by_class = {}
+    for item in items:
+        by_class.setdefault(_GROUP_CLASS[item.kind], []).append(item)
+    groups = []
+    for class_items in by_class.values():
+        count = -(-len(class_items) // MEDIA_GROUP_LIMIT) # Ceiling division
+        size, extra = divmod(len(class_items), count)
+        start = 0
+        for i in range(count):
+            end = start + size + (1 if i < extra else 0)
+            groups.append(class_items[start:end])
+            start = end
+    return groups
+
+def _file_id(message):
+    if message.photo:
+        return message.photo[-1].file_id # Largest size
+    for attachment in (message.video, message.audio, message.document, message.animation):
+        if attachment is not None:
+            return attachment.file_id
+    return None
+
+def _media_source(item, stack):
+    if item.file_id is not None:
+        return item.file_id
+    return stack.enter_context(open(item.path, 'rb'))
+
+async def _send_single(message, item, caption):
+    with contextlib.ExitStack() as stack:
+        media = _media_source(item, stack)
+        if item.kind == 'video':
+            return await message.reply_video(video=media, caption=caption)
+        if item.kind == 'photo':
+            return await message.reply_photo(photo=media, caption=caption)
+        if item.kind == 'audio':
+            return await message.reply_audio(audio=media, caption=caption)
+        return await message.reply_document(document=media, caption=caption)
+
+async def send_media_items(message, items, caption, file_id_cache=None):
+    """
+    Replies to `message` with every item, as media groups where possible. `caption` goes
+    on the first item. The file_ids Telegram assigns are stored in `file_id_cache`.
+    """
+    for index, group in enumerate(split_media_groups(items)):
+        group_caption = caption if index == 0 else None
+        if len(group) == 1:
+            sent = [await _send_single(message, group[0], group_caption)]
+        else:
+            with contextlib.ExitStack() as stack:
+                media = [
+                    _INPUT_MEDIA[item.kind](
+                        media=_media_source(item, stack),
+                        caption=group_caption if i == 0 else None,
+                        filename=os.path.basename(item.path) if item.path else None
+                    )
+                    for i, item in enumerate(group)
+                ]
+                sent = await message.reply_media_group(media=media)
+        if file_id_cache is not None:
+            for item, sent_message in zip(group, sent):
+                file_id_cache.put(item.key, item.kind, _file_id(sent_message))
+
+class ChatThrottle:
+    """Spaces out message edits per chat, shared by every job in the chat, to stay under Telegram's flood limits."""
+
+    def __init__(self, interval=3.0):
+        self.interval = interval
+        self._next_edit = {} # chat_id -> loop time of the next allowed edit
+
+    def defer(self, chat_id, seconds=None):
+        """Pushes the chat's next edit at least `seconds` (default: one interval) into the future."""
+        loop_time = asyncio.get_running_loop().time()
+        at = loop_time + (self.interval if seconds is None else seconds)
+        self._next_edit[chat_id] = max(self._next_edit.get(chat_id, 0), at)
+
+    async def wait(self, chat_id):
+        """Waits for the chat's next edit slot and claims it."""
+        loop_time = asyncio.get_running_loop().time()
+        at = max(self._next_edit.get(chat_id, 0), loop_time)
+        self._next_edit[chat_id] = at + self.interval
+        if len(self._next_edit) > 1000: # Forget chats that have been quiet for a while
+            self._next_edit = {chat: t for chat, t in self._next_edit.items() if t > loop_time}
+        if at > loop_time:
+            await asyncio.sleep(at - loop_time)
+
+class ProgressReporter:
+    """
+    Keeps one status message per download job up to date: queue position while waiting,
+    then percent done, speed and finished items while yt-dlp downloads. Progress arrives
+    from worker threads through `hook(index)`; edits are coalesced so only the latest
+    state is shown, at most once per ChatThrottle interval in each chat.
+    """
+
+    def __init__(self, status_message, throttle, item_count=1):
+        self.status_message = status_message
+        self.chat_id = status_message.chat_id
+        self.throttle = throttle
+        self.item_count = item_count
+        self.queue_position = None
+        self.uploading = False
+        self._progress = {} # item index -> (downloaded bytes, total bytes or 0, speed or None)
+        self._finished = set()
+        self._loop = asyncio.get_running_loop()
+        self._wakeup_pending = False
+        self._dirty = False
+        self._closed = False
+        self._task = None
+        self._last_text = status_message.text
+        throttle.defer(self.chat_id) # The status message itself was just sent
+
+    def hook(self, index):
+        """yt-dlp progress hook for item `index`; runs in the download thread."""
+        def progress_hook(d):
+            status = d.get('status')
+            if status == 'downloading':
+                total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+                self._progress[index] = (d.get('downloaded_bytes') or 0, total, d.get('speed'))
+            elif status == 'finished':
+                self._finished.add(index)
+            else:
+                return
+            if not self._wakeup_pending: # yt-dlp calls this for every block; wake the loop once per batch
+                self._wakeup_pending = True
+                try:
+                    self._loop.call_soon_threadsafe(self.refresh)
+                except RuntimeError:
+                    pass # Loop already closed (shutting down)
+        return progress_hook
+
+    def set_queue_position(self, position):
+        if position != self.queue_position:
+            self.queue_position = position
+            self.refresh()
+
+    def set_uploading(self):
+        self.uploading = True
+        self.refresh()
+
+    def refresh(self):
+        """Schedules an edit with the current state (on the event loop)."""
+        self._wakeup_pending = False
+        if self._closed:
+            return
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def render(self):
+        if self.queue_position is not None and not self._progress:
+            return f"لینک شما در صف دانلود است (نفر {self.queue_position}). لطفاً منتظر بمانید..."
+        if self.uploading:
+            return "دانلود تمام شد، در حال ارسال..."
+        if not self._progress and not self._finished:
+            return self.status_message.text
+
+        done = 0.0
+        speed = 0.0
+        for index in range(self.item_count):
+            if index in self._finished:
+                done += 1
+                continue
+            downloaded, total, item_speed = self._progress.get(index, (0, 0, None))
+            if total:
+                done += min(downloaded / total, 1.0)
+            speed += item_speed or 0
+        text = f"در حال دانلود... {done * 100 / self.item_count:.0f}%"
+        if speed:
+            text += f" | {speed / (1024 * 1024):.1f} MB/s"
+        if self.item_count > 1:
+            text += f"\nموارد تکمیل‌شده: {len(self._finished)} از {self.item_count}"
+        return text
+
+    async def _run(self):
+        while self._dirty and not self._closed:
+            await self.throttle.wait(self.chat_id)
+            if self._closed:
+                return
+            self._dirty = False
+            await self._edit(self.render())
+
+    async def _edit(self, text):
+        if text == self._last_text:
+            return
+        try:
+            await self.status_message.edit_text(text)
+            self._last_text = text
+        except RetryAfter as e:
+            self.throttle.defer(self.chat_id, retry_after_seconds(e.retry_after))
+            self._dirty = True # Try again with whatever is current by then
+        except BadRequest as e:
+            logger.debug(f"Could not update download status: {e}") # e.g. the message was deleted
+
+    def close(self):
+        """Stops further edits."""
+        self._closed = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def finish(self):
+        """The results were sent; the status message has nothing left to say."""
+        self.close()
+        try:
+            await self.status_message.delete()
+        except Exception as e:
+            logger.debug(f"Could not delete download status: {e}")
+
+    async def fail(self, text):
+        """Turns the status message into the error message (or replies if it can't be edited)."""
+        self.close()
+        try:
+            await self.status_message.edit_text(text)
+        except Exception:
+            await self.status_message.reply_text(text)
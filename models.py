@@ -0,0 +1,78 @@
+from datetime import datetime
+
+from sqlalchemy import create_engine, Column, Integer, String, BigInteger, DateTime, Text, Boolean
+from sqlalchemy.orm import sessionmaker, declarative_base
+
+import database
+from welcome_template import DEFAULT_WELCOME_TEXT, LEGACY_DEFAULT_WELCOME_TEXT
+
+# Bump this whenever a table or index is added, so existing databases get the new schema
+SCHEMA_VERSION = 7
+
+# Create a SQLite database engine. 'digitalbot.db' file will be created.
+engine = create_engine(f'sqlite:///{database.DATABASE_NAME}')
+Base = declarative_base() # Base class for our models
+Session = sessionmaker(bind=engine) # Session factory
+
+# Define models (database tables)
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(BigInteger, primary_key=True) # Telegram User ID
+    username = Column(String, nullable=True)
+    first_name = Column(String, nullable=False)
+    last_name = Column(String, nullable=True)
+    
+    total_messages = Column(Integer, default=0)
+    daily_messages = Column(Integer, default=0)
+    hourly_messages = Column(Integer, default=0)
+    weekly_messages = Column(Integer, default=0)
+    monthly_messages = Column(Integer, default=0)
+    last_message_time = Column(DateTime, default=datetime.min)
+    
+    warnings = Column(Integer, default=0) # Unused: warnings are counted per chat in database.chat_warnings
+    is_special = Column(Boolean, default=False) # Special user
+    
+    def __repr__(self):
+        return f"<User(id={self.id}, username='{self.username}', total_messages={self.total_messages})>"
+
+class ChatSettings(Base):
+    __tablename__ = 'chat_settings'
+    chat_id = Column(BigInteger, primary_key=True)
+    welcome_text = Column(Text, default=DEFAULT_WELCOME_TEXT)
+    welcome_media_id = Column(String, nullable=True)
+    welcome_media_type = Column(String, nullable=True) # 'photo', 'video'
+    warning_limit = Column(Integer, default=5)
+    
+    def __repr__(self):
+        return f"<ChatSettings(chat_id={self.chat_id})>"
+
+class BotOwner(Base):
+    __tablename__ = 'bot_owner'
+    user_id = Column(BigInteger, primary_key=True) # Bot owner's User ID
+    
+    def __repr__(self):
+        return f"<BotOwner(user_id={self.user_id})>"
+
+def init_schema():
+    """
+    Creates the ORM tables and the tables from database.py, but only when the file's
+    schema version (SQLite's user_version) is older than SCHEMA_VERSION.
+    Returns True if the schema was (re)created.
+    """
+    with engine.connect() as conn:
+        current_version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+    if current_version >= SCHEMA_VERSION:
+        return False
+
+    database.configure_storage() # Before any table exists, so new files start with incremental auto-vacuum
+    # Create all tables in the database (if they don't exist)
+    Base.metadata.create_all(engine)
+    database.init_db()
+    with engine.begin() as conn:
+        # Chats still on the old default would stop mentioning new members now that the text is rendered
+        conn.exec_driver_sql(
+            "UPDATE chat_settings SET welcome_text = ? WHERE welcome_text = ?",
+            (DEFAULT_WELCOME_TEXT, LEGACY_DEFAULT_WELCOME_TEXT)
+        )
+        conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return True
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from telegram import ChatPermissions
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from supervisor import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+BAN = 'ban'
+UNBAN = 'unban'
+MUTE = 'mute'
+
+# State of each user in a bulk job (database.moderation_job_items)
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+MAX_ATTEMPTS = 4 # Per user, for flood waits and timeouts; Telegram rejecting the user is final
+
+async def apply_action(bot, chat_id, action, user_id, duration_seconds=None):
+    """One API call per user. Unban skips users who aren't banned instead of kicking members."""
+    if action == BAN:
+        await bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
+    elif action == UNBAN:
+        await bot.unban_chat_member(chat_id=chat_id, user_id=user_id, only_if_banned=True)
+    elif action == MUTE:
+        # Computed per call: Telegram treats an until_date less than 30 s away as "forever"
+        await bot.restrict_chat_member(
+            chat_id=chat_id,
+            user_id=user_id,
+            permissions=ChatPermissions(can_send_messages=False),
+            until_date=datetime.now() + timedelta(seconds=duration_seconds)
+        )
+    else:
+        raise ValueError(f"Unknown moderation action: {action}")
+
+class BulkAction:
+    """
+    Applies one moderation action to many users with at most `concurrency` API calls in
+    flight. A flood wait (RetryAfter) pauses every worker, not just the one that hit it.
+    Results are handed to `on_results(rows)` in batches of (status, error, user_id) rows
+    as they come in, so a job interrupted halfway keeps what it already did.
+    """
+
+    def __init__(self, bot, chat_id, action, duration_seconds=None, concurrency=5, batch_size=50):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.action = action
+        self.duration_seconds = duration_seconds
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._resume_at = 0.0 # Loop time before which no worker may call the API
+
+    async def _wait_for_flood(self):
+        loop = asyncio.get_running_loop()
+        while loop.time() < self._resume_at:
+            await asyncio.sleep(self._resume_at - loop.time())
+
+    async def _run_one(self, semaphore, user_id):
+        async with semaphore:
+            error = None
+            for attempt in range(MAX_ATTEMPTS):
+                await self._wait_for_flood()
+                try:
+                    await apply_action(self.bot, self.chat_id, self.action, user_id, self.duration_seconds)
+                    return (DONE, None, user_id)
+                except RetryAfter as e:
+                    error = e
+                    loop_time = asyncio.get_running_loop().time()
+                    self._resume_at = max(self._resume_at, loop_time + retry_after_seconds(e.retry_after))
+                except (BadRequest, Forbidden) as e:
+                    return (FAILED, e.message, user_id) # e.g. user is an admin, bot lacks rights
+                except NetworkError as e:
+                    error = e
+                    await asyncio.sleep(attempt + 1)
+            return (FAILED, str(error), user_id)
+
+    async def run(self, user_ids, on_results=None):
+        """Returns the number of users the action succeeded for."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [asyncio.ensure_future(self._run_one(semaphore, user_id)) for user_id in user_ids]
+        done = 0
+        rows = []
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                row = await next_result
+                done += row[0] == DONE
+                rows.append(row)
+                if on_results is not None and len(rows) >= self.batch_size:
+                    on_results(rows)
+                    rows = []
+        finally:
+            for task in tasks:
+                task.cancel()
+            if on_results is not None and rows:
+                on_results(rows)
+        return done
@@ -0,0 +1,76 @@
+import asyncio
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Only one profile at a time, so concurrent requests can't stack up sampling overhead
+_profile_lock = threading.Lock()
+
+def _frame_label(frame):
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f"{os.path.basename(code.co_filename)}:{name}"
+
+def sample_stacks(seconds, interval=0.005):
+    """
+    Samples the stack of every thread except the caller's every `interval` seconds for
+    `seconds` seconds. Returns a Counter of collapsed stacks ("thread;outer;...;inner").
+    Raises RuntimeError if another profile is already running.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+    try:
+        own_thread = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(thread_names.get(thread_id, f"thread-{thread_id}"))
+                stacks[";".join(reversed(labels))] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _profile_lock.release()
+
+def format_collapsed(stacks):
+    """Collapsed-stack text (one "stack count" line per stack), as read by flamegraph.pl or speedscope."""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+def _describe_task(task):
+    coro = task.get_coro()
+    lines = [f"{task.get_name()}: {getattr(coro, '__qualname__', coro)}"]
+    for frame in task.get_stack(limit=20):
+        lines.append(f"    {frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}")
+    return "\n".join(lines)
+
+async def _collect_tasks():
+    current = asyncio.current_task()
+    return [_describe_task(task) for task in asyncio.all_tasks() if task is not current and not task.done()]
+
+def dump_asyncio_tasks(loop, timeout=5.0):
+    """
+    Describes every pending task on `loop` (name, coroutine and await stack) from another thread.
+    The dump runs on the loop itself; if the loop doesn't respond within `timeout` it is stalled,
+    and the tasks are read from this thread instead.
+    """
+    if loop is None or loop.is_closed():
+        return "Event loop is not running.\n"
+    future = asyncio.run_coroutine_threadsafe(_collect_tasks(), loop)
+    try:
+        descriptions = future.result(timeout)
+        header = f"{len(descriptions)} pending tasks"
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        descriptions = [_describe_task(task) for task in asyncio.all_tasks(loop) if not task.done()]
+        header = f"Event loop did not respond within {timeout:.0f}s (it is blocked). {len(descriptions)} pending tasks"
+    return header + ":\n\n" + "\n\n".join(descriptions) + "\n"
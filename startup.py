@@ -0,0 +1,68 @@
+import importlib
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Taken as early as possible: Bot.py imports this module before anything heavy
+PROCESS_START = time.perf_counter()
+
+class StartupTimer:
+    """Collects how long each boot step takes and logs a report once polling is about to start."""
+
+    def __init__(self):
+        self.steps = [] # list of (step name, seconds)
+        self.reported = False
+
+    def record(self, name, seconds):
+        self.steps.append((name, seconds))
+        if self.reported:
+            # Boot is over, so this is a lazy load on first use
+            logger.info(f"{name} took {seconds * 1000:.0f} ms (first use)")
+
+    @contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def report(self):
+        """Logs the time spent in each recorded step and the total time since process start."""
+        if self.reported:
+            return
+        self.reported = True
+        total = time.perf_counter() - PROCESS_START
+        lines = [f"Startup finished in {total * 1000:.0f} ms:"]
+        for name, seconds in self.steps:
+            lines.append(f"  {name:<30} {seconds * 1000:8.0f} ms")
+        accounted = sum(seconds for _, seconds in self.steps)
+        lines.append(f"  {'(other)':<30} {max(total - accounted, 0) * 1000:8.0f} ms")
+        logger.info("\n".join(lines))
+
+startup_timer = StartupTimer()
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            start = time.perf_counter()
+            module = self._module = importlib.import_module(self._name)
+            startup_timer.record(f"import {self._name}", time.perf_counter() - start)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<LazyModule({self._name}, {state})>"
@@ -0,0 +1,40 @@
+import csv
+import io
+import json
+import zipfile
+
+import database
+
+FORMATS = ('csv', 'jsonl')
+
+def write_chat_export(chat_id, path, fmt='csv'):
+    """
+    Writes a chat's member stats and full activity history (all tiers) to a zip file at `path`,
+    one compressed member per table. Rows are streamed from the database in chunks and
+    written straight into the archive, so memory use doesn't grow with the group size.
+    Returns a dict of table name -> rows written.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}'")
+
+    # utf-8-sig so spreadsheet programs detect UTF-8 and show Persian names correctly
+    encoding = 'utf-8-sig' if fmt == 'csv' else 'utf-8'
+    counts = {}
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, (columns, _) in database.EXPORT_QUERIES.items():
+            counts[name] = 0
+            with archive.open(f"{name}.{fmt}", 'w', force_zip64=True) as raw, \
+                    io.TextIOWrapper(raw, encoding=encoding, newline='') as out:
+                if fmt == 'csv':
+                    writer = csv.writer(out)
+                    writer.writerow(columns)
+                    for rows in database.iter_export_chunks(name, chat_id):
+                        writer.writerows(rows)
+                        counts[name] += len(rows)
+                else:
+                    for rows in database.iter_export_chunks(name, chat_id):
+                        out.write("".join(
+                            json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows
+                        ))
+                        counts[name] += len(rows)
+    return counts
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import random
+import signal
+import time
+
+from telegram.error import Conflict, InvalidToken, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Errors worth reconnecting after. TimedOut is a NetworkError; Conflict means another
+# instance is still polling (e.g. the previous deploy), which usually clears up on its own.
+RECOVERABLE_ERRORS = (NetworkError, RetryAfter, Conflict, ConnectionError, OSError)
+
+def retry_after_seconds(retry_after):
+    """RetryAfter.retry_after is a timedelta in newer PTB versions and a number of seconds in older ones."""
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+def is_recoverable(error):
+    """InvalidToken and programming errors are fatal, network trouble is not."""
+    if isinstance(error, InvalidToken):
+        return False
+    return isinstance(error, RECOVERABLE_ERRORS)
+
+class Backoff:
+    """Exponential backoff with full jitter: each delay is uniform in [0, min(cap, base * 2**attempt)]."""
+
+    def __init__(self, base=1.0, cap=300.0):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self, error=None):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempt))
+        self.attempt += 1
+        if isinstance(error, RetryAfter):
+            # Telegram told us exactly how long to wait
+            delay = max(delay, retry_after_seconds(error.retry_after))
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+class BotSupervisor:
+    """
+    Keeps one Application alive for the life of the process.
+
+    Only the updater (the getUpdates connection) is restarted on network errors, so
+    handlers, caches, the database engine and tasks started with create_task survive
+    a reconnect. On SIGINT/SIGTERM or a fatal error the updater is stopped, running
+    handler tasks are drained, shutdown hooks flush pending work and only then is the
+    application shut down.
+    """
+
+    # Polling that stays up this long counts as recovered and resets the backoff
+    STABLE_AFTER = 60.0
+
+    def __init__(self, application, allowed_updates=None, shutdown_hooks=()):
+        self.application = application
+        self.allowed_updates = allowed_updates
+        self.shutdown_hooks = list(shutdown_hooks) # async callables run after draining
+        self.backoff = Backoff()
+        self._stop = None
+        self._reconnect = None
+        self._error = None
+        self._post_init_done = False
+
+    def add_shutdown_hook(self, hook):
+        self.shutdown_hooks.append(hook)
+
+    def request_stop(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    def _on_polling_error(self, error):
+        # Called by the updater from its polling task; must not be a coroutine.
+        logger.warning(f"Polling error: {error}")
+        self._error = error
+        self._reconnect.set()
+
+    def _install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+            except (NotImplementedError, RuntimeError):
+                pass # Not supported on this platform / not in the main thread
+
+    async def _wait_or_stop(self, delay):
+        """Sleeps for `delay` seconds, returning early (True) if a stop was requested."""
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout=delay)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _connect(self):
+        """Initializes (once) and starts the application, then starts polling."""
+        application = self.application
+        await application.initialize() # No-op after the first successful call
+        if not self._post_init_done:
+            # Only run_polling/run_webhook call post_init, so run it here like they do: once, before start()
+            if application.post_init:
+                await application.post_init(application)
+            self._post_init_done = True
+        if not application.running:
+            await application.start()
+        await application.updater.start_polling(
+            allowed_updates=self.allowed_updates,
+            error_callback=self._on_polling_error
+        )
+
+    async def run(self):
+        self._stop = asyncio.Event()
+        self._reconnect = asyncio.Event()
+        self._install_signal_handlers()
+
+        fatal_error = None
+        try:
+            while not self._stop.is_set():
+                self._reconnect.clear()
+                self._error = None
+                try:
+                    await self._connect()
+                except Exception as e:
+                    self._error = e
+                else:
+                    logger.info("DigitalBot started successfully. Listening for updates...")
+                    started_at = time.monotonic()
+                    stop_task = asyncio.ensure_future(self._stop.wait())
+                    reconnect_task = asyncio.ensure_future(self._reconnect.wait())
+                    await asyncio.wait({stop_task, reconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+                    stop_task.cancel()
+                    reconnect_task.cancel()
+                    if self._stop.is_set():
+                        break
+                    if time.monotonic() - started_at >= self.STABLE_AFTER:
+                        self.backoff.reset()
+                    await self._stop_updater()
+
+                error = self._error
+                if not is_recoverable(error):
+                    fatal_error = error
+                    logger.error(f"Fatal error, shutting down: {error}", exc_info=error)
+                    break
+
+                delay = self.backoff.next_delay(error)
+                logger.warning(f"Connection problem ({error}). Reconnecting in {delay:.1f} seconds...")
+                if await self._wait_or_stop(delay):
+                    break
+        finally:
+            await self._shutdown()
+
+        if fatal_error is not None:
+            raise fatal_error
+
+    async def _stop_updater(self):
+        updater = self.application.updater
+        if updater.running:
+            try:
+                await updater.stop()
+            except Exception as e:
+                logger.error(f"Error stopping updater: {e}")
+
+    async def _shutdown(self):
+        """Stops fetching updates, drains in-flight work, runs the shutdown hooks and releases resources."""
+        logger.info("Shutting down DigitalBot...")
+        application = self.application
+        await self._stop_updater()
+        if application.running:
+            try:
+                # Waits for queued updates and tasks created with application.create_task
+                await application.stop()
+            except Exception as e:
+                logger.error(f"Error stopping application: {e}")
+        for hook in self.shutdown_hooks:
+            try:
+                await hook()
+            except Exception as e:
+                logger.error(f"Error in shutdown hook {getattr(hook, '__name__', hook)}: {e}")
+        try:
+            await application.shutdown()
+        except Exception as e:
+            logger.error(f"Error shutting down application: {e}")
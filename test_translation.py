@@ -0,0 +1,34 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from translation import split_text
+
+def rejoin(chunks):
+    return "".join(chunk + separator for chunk, separator in chunks)
+
+class SplitTextTest(unittest.TestCase):
+
+    def test_short_text_round_trips_unchanged(self):
+        for text in ('He said "hi." Then he left.', '(Hello world.) Next one.', 'a  b.  c',
+                     'سلام! حالت چطوره؟ «خوبم.» ممنون', '\n  first line \n\n second\n'):
+            chunks = split_text(text)
+            self.assertEqual(rejoin(chunks), text)
+            self.assertEqual([chunk for chunk, _ in chunks if chunk], [line.strip() for line in text.split("\n") if line.strip()])
+
+    def test_long_line_splits_after_closing_quotes(self):
+        text = 'He said "hi."  Then (he left.) And that was it.'
+        chunks = split_text(text, max_chars=20)
+        self.assertEqual(rejoin(chunks), text)
+        self.assertEqual([chunk for chunk, _ in chunks], ['He said "hi."', 'Then (he left.)', 'And that was it.'])
+
+    def test_over_long_words_are_hard_split(self):
+        text = "x" * 25 + " tail."
+        chunks = split_text(text, max_chars=10)
+        self.assertEqual(rejoin(chunks), text)
+        self.assertTrue(all(len(chunk) <= 10 for chunk, _ in chunks))
+
+if __name__ == "__main__":
+    unittest.main()
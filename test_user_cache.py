@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from unittest import mock
+
+# The database file is relative to the working directory; keep the real one untouched
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="digitalbot_test_"))
+
+import database
+import models
+from user_cache import UserCache
+
+models.init_schema()
+
+class UserCacheEvictionTest(unittest.TestCase):
+
+    def test_evicted_changes_survive_reload_and_flush(self):
+        cache = UserCache(capacity=1)
+        user = cache.get_or_create(1001, "first", "First", None)
+        for _ in range(5):
+            user.record_message(datetime.now())
+        cache.mark_dirty(user)
+
+        cache.get_or_create(1002, "second", "Second", None) # Evicts user 1001 with unflushed changes
+        user = cache.get(1001)
+        user.record_message(datetime.now())
+        cache.mark_dirty(user)
+        cache.flush()
+
+        self.assertEqual(database.load_user(1001)[database.USER_COLUMNS.index('total_messages')], 6)
+
+    def test_evicted_special_flag_survives_reload(self):
+        cache = UserCache(capacity=1)
+        user = cache.get_or_create(2001, "special", "Special", None)
+        user.is_special = True
+        cache.mark_dirty(user)
+
+        cache.get_or_create(2002, "other", "Other", None)
+        self.assertTrue(cache.get(2001).is_special)
+        cache.flush()
+
+        self.assertEqual(database.load_user(2001)[database.USER_COLUMNS.index('is_special')], 1)
+    def test_lookup_during_flush_keeps_the_rows_being_written(self):
+        cache = UserCache(capacity=1)
+        user = cache.get_or_create(3001, "busy", "Busy", None)
+        for _ in range(5):
+            user.record_message(datetime.now())
+        cache.mark_dirty(user)
+        cache.get_or_create(3002, "other", "Other", None) # Evicts user 3001 with unflushed changes
+
+        writing = threading.Event()
+        release = threading.Event()
+        update_users = database.update_users
+
+        def slow_update_users(rows):
+            writing.set()
+            release.wait(5)
+            update_users(rows)
+
+        with mock.patch.object(database, 'update_users', slow_update_users):
+            flusher = threading.Thread(target=cache.flush)
+            flusher.start()
+            self.assertTrue(writing.wait(5))
+            user = cache.get(3001) # The database still has the old row here
+            user.record_message(datetime.now())
+            cache.mark_dirty(user)
+            release.set()
+            flusher.join(5)
+        cache.flush()
+
+        self.assertEqual(database.load_user(3001)[database.USER_COLUMNS.index('total_messages')], 6)
+
+if __name__ == "__main__":
+    unittest.main()
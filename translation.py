@@ -0,0 +1,176 @@
+import asyncio
+import re
+
+# Google's web endpoint rejects long texts; chunks stay well below its ~5000 character limit
+MAX_CHUNK_CHARS = 1500
+MAX_BATCH_CHARS = 4500
+
+# A sentence ends at . ! ? ؟ … plus any closing quotes/brackets; group 1 is the whitespace after it
+_SENTENCE_END = re.compile(r'[.!?؟…]["\')\]»]*(\s+)')
+_WORD_GAP = re.compile(r'(\s+)')
+
+def split_text(text, max_chars=MAX_CHUNK_CHARS):
+    """
+    Splits text into chunks of at most `max_chars`. Every line is one chunk unless it is
+    longer than `max_chars`, in which case it is split at sentence boundaries, then at
+    spaces. Returns (chunk, separator) pairs, where the separator is the exact whitespace
+    that followed the chunk, so joining chunk + separator for every pair gives back the
+    original text. Chunks never contain line breaks; the first chunk is empty if the text
+    starts with whitespace.
+    """
+    chunks = []
+    gap = "" # Whitespace since the last chunk
+    for index, line in enumerate(text.split("\n")):
+        if index:
+            gap += "\n"
+        content = line.strip()
+        if not content:
+            gap += line
+            continue
+        start = line.index(content)
+        gap += line[:start]
+        if chunks:
+            chunks[-1] = (chunks[-1][0], gap)
+        elif gap:
+            chunks.append(("", gap))
+        chunks.extend(_split_line(content, max_chars))
+        gap = line[start + len(content):]
+    if not chunks:
+        return []
+    chunks[-1] = (chunks[-1][0], gap)
+    return chunks
+
+def _cut(text, pattern):
+    """Cuts text before each match's group 1; returns (piece, separator) pairs."""
+    pieces = []
+    start = 0
+    for match in pattern.finditer(text):
+        pieces.append((text[start:match.start(1)], match.group(1)))
+        start = match.end(1)
+    pieces.append((text[start:], ""))
+    return pieces
+
+def _split_line(line, max_chars):
+    """Splits a stripped line into (chunk, separator) pairs, leaving lines within the limit whole."""
+    if len(line) <= max_chars:
+        return [(line, "")]
+    pieces = []
+    for sentence, separator in _cut(line, _SENTENCE_END):
+        if len(sentence) <= max_chars:
+            pieces.append((sentence, separator))
+            continue
+        words = _cut(sentence, _WORD_GAP)
+        words[-1] = (words[-1][0], separator)
+        for word, word_separator in words:
+            # Words longer than the limit are hard-split
+            while len(word) > max_chars:
+                pieces.append((word[:max_chars], ""))
+                word = word[max_chars:]
+            pieces.append((word, word_separator))
+
+    chunks = []
+    current = None
+    current_separator = ""
+    for piece, separator in pieces:
+        if current is not None and len(current) + len(current_separator) + len(piece) <= max_chars:
+            current += current_separator + piece
+        else:
+            if current is not None:
+                chunks.append((current, current_separator))
+            current = piece
+        current_separator = separator
+    chunks.append((current, current_separator))
+    return chunks
+
+class TranslationPipeline:
+    """
+    Translates text through a blocking `backend(text, dest) -> str`.
+
+    Long texts are split into chunks that are translated concurrently (at most
+    `max_concurrency` backend calls at once) and reassembled in order. Chunks requested
+    within `batch_window` seconds of each other, from any number of callers, are packed
+    into one backend call as separate lines and split apart again; if the backend
+    doesn't return the same number of lines, those chunks are retried one by one.
+    """
+
+    def __init__(self, backend, max_concurrency=4, batch_window=0.05,
+                 max_chunk_chars=MAX_CHUNK_CHARS, max_batch_chars=MAX_BATCH_CHARS):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.batch_window = batch_window
+        self.max_chunk_chars = max_chunk_chars
+        self.max_batch_chars = max_batch_chars
+        self._semaphore = None
+        self._pending = [] # (chunk, dest, future) waiting for the next batch
+        self._flush_handle = None
+        self._tasks = set() # Running batches; referenced so they aren't garbage collected
+
+    async def translate(self, text, dest='fa'):
+        chunks = split_text(text, self.max_chunk_chars)
+        if not chunks:
+            return ""
+        translated = iter(await asyncio.gather(*(self._submit(chunk, dest) for chunk, _ in chunks if chunk)))
+        return "".join((next(translated) if chunk else "") + separator for chunk, separator in chunks)
+
+    def _submit(self, chunk, dest):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((chunk, dest, future))
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, []
+
+        batches = {} # dest -> list of batches, each a list of (chunk, future)
+        for chunk, dest, future in pending:
+            dest_batches = batches.setdefault(dest, [[]])
+            current = dest_batches[-1]
+            size = sum(len(c) + 1 for c, _ in current)
+            if current and size + len(chunk) > self.max_batch_chars:
+                current = []
+                dest_batches.append(current)
+            current.append((chunk, future))
+
+        for dest, dest_batches in batches.items():
+            for batch in dest_batches:
+                task = asyncio.ensure_future(self._run_batch(batch, dest))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _call_backend(self, text, dest):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await asyncio.to_thread(self.backend, text, dest)
+
+    async def _run_batch(self, batch, dest):
+        try:
+            if len(batch) > 1:
+                try:
+                    result = await self._call_backend("\n".join(chunk for chunk, _ in batch), dest)
+                except Exception:
+                    result = "" # Fall through to translating the chunks one by one
+                lines = result.split("\n")
+                if len(lines) == len(batch):
+                    for (_, future), line in zip(batch, lines):
+                        if not future.done():
+                            future.set_result(line.strip())
+                    return
+            # Single chunk, or the batched call failed or merged/split lines: translate each chunk on its own
+            results = await asyncio.gather(
+                *(self._call_backend(chunk, dest) for chunk, _ in batch), return_exceptions=True
+            )
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
@@ -0,0 +1,186 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import database
+
+class UserRecord:
+    """Compact in-memory copy of a users row."""
+    __slots__ = (
+        'id', 'username', 'first_name', 'last_name',
+        'total_messages', 'daily_messages', 'hourly_messages', 'weekly_messages', 'monthly_messages',
+        'last_message_time', 'is_special', 'dirty',
+    )
+
+    def __init__(self, id, username, first_name, last_name, total_messages=0, daily_messages=0,
+                 hourly_messages=0, weekly_messages=0, monthly_messages=0,
+                 last_message_time=datetime.min, is_special=False):
+        self.id = id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.total_messages = total_messages
+        self.daily_messages = daily_messages
+        self.hourly_messages = hourly_messages
+        self.weekly_messages = weekly_messages
+        self.monthly_messages = monthly_messages
+        self.last_message_time = last_message_time
+        self.is_special = is_special
+        self.dirty = False
+
+    @classmethod
+    def from_row(cls, row):
+        (user_id, username, first_name, last_name, total, daily, hourly, weekly, monthly,
+         last_message_time, is_special) = row
+        return cls(user_id, username, first_name, last_name, total or 0, daily or 0, hourly or 0,
+                   weekly or 0, monthly or 0, database.parse_db_datetime(last_message_time), bool(is_special))
+
+    def to_row(self):
+        """Values for database.update_users: USER_COUNTER_COLUMNS, then the id."""
+        return (
+            self.username, self.first_name, self.last_name,
+            self.total_messages, self.daily_messages, self.hourly_messages, self.weekly_messages,
+            self.monthly_messages, database.format_db_datetime(self.last_message_time), int(self.is_special),
+            self.id,
+        )
+
+    def record_message(self, now):
+        """Counts one message, resetting the daily/hourly/weekly/monthly counters when their period changed."""
+        last_time = self.last_message_time
+        self.total_messages += 1
+
+        # Reset daily if new day (or new month/year, covers all)
+        if now.date() != last_time.date():
+            self.daily_messages = 0
+        self.daily_messages += 1
+
+        # Reset hourly if new hour (or new day, covers all)
+        if now.hour != last_time.hour or now.date() != last_time.date():
+            self.hourly_messages = 0
+        self.hourly_messages += 1
+
+        # Reset weekly on a new ISO week (the ISO year is part of the comparison)
+        if now.isocalendar()[:2] != last_time.isocalendar()[:2]:
+            self.weekly_messages = 0
+        self.weekly_messages += 1
+
+        # Reset monthly if new month (or new year, covers all)
+        if (now.year, now.month) != (last_time.year, last_time.month):
+            self.monthly_messages = 0
+        self.monthly_messages += 1
+
+        self.last_message_time = now
+
+    def __repr__(self):
+        return f"<UserRecord(id={self.id}, username='{self.username}', total_messages={self.total_messages})>"
+
+class UserCache:
+    """
+    LRU cache of UserRecords in front of the users table.
+
+    Reads are served from memory. Changes are kept on the record (mark_dirty) and written
+    back in one executemany by flush(). A dirty record evicted before the next flush is
+    kept in a pending list until then, and rows being written by a flush stay visible until
+    it commits, so a lookup never reloads an older database row. flush() may run in a
+    worker thread, so all access to the cache structures holds a lock.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.records = OrderedDict() # user_id -> UserRecord, least recently used first
+        self.pending_rows = {} # user_id -> row of an evicted dirty record
+        self.flushing_rows = {} # user_id -> row the running flush is writing
+        self.lock = threading.Lock()
+
+    def _remember(self, record):
+        self.records[record.id] = record
+        while len(self.records) > self.capacity:
+            _, evicted = self.records.popitem(last=False)
+            if evicted.dirty:
+                self.pending_rows[evicted.id] = evicted.to_row()
+
+    def _restore_pending(self, user_id):
+        """
+        Brings back an evicted record whose changes aren't in the database yet, either waiting
+        for the next flush or being written by the running one (caller holds the lock).
+        """
+        row = self.pending_rows.pop(user_id, None)
+        dirty = row is not None
+        if row is None:
+            row = self.flushing_rows.get(user_id)
+            if row is None:
+                return None
+        record = UserRecord.from_row((row[-1],) + row[:-1]) # Pending rows have the id last
+        record.dirty = dirty # A flushing row is marked dirty again if its flush fails
+        self._remember(record)
+        return record
+
+    def get(self, user_id):
+        """Returns the user's record, loading it from the database on a miss, or None if unknown."""
+        with self.lock:
+            record = self.records.get(user_id)
+            if record is not None:
+                self.records.move_to_end(user_id)
+                return record
+            # The database copy is older than an unflushed evicted record
+            record = self._restore_pending(user_id)
+            if record is not None:
+                return record
+        row = database.load_user(user_id)
+        if row is None:
+            return None
+        with self.lock:
+            # Another thread may have loaded it (or it was evicted) meanwhile; keep the newest copy
+            record = self.records.get(user_id) or self._restore_pending(user_id)
+            if record is None:
+                record = UserRecord.from_row(row)
+                self._remember(record)
+            return record
+
+    def get_or_create(self, user_id, username, first_name, last_name):
+        """Returns the user's record, creating the row if needed and refreshing changed names."""
+        record = self.get(user_id)
+        if record is None:
+            database.insert_user(user_id, username, first_name, last_name)
+            record = self.get(user_id)
+        elif (record.username, record.first_name, record.last_name) != (username, first_name or "", last_name):
+            record.username = username
+            record.first_name = first_name or ""
+            record.last_name = last_name
+            self.mark_dirty(record)
+        return record
+
+    def mark_dirty(self, record):
+        record.dirty = True
+
+    def flush(self):
+        """Writes all changed records back in one batch. Returns the number of rows written."""
+        with self.lock:
+            rows = dict(self.pending_rows)
+            self.pending_rows.clear()
+            for record in self.records.values():
+                if record.dirty:
+                    rows[record.id] = record.to_row()
+                    record.dirty = False
+            if not rows:
+                return 0
+            self.flushing_rows = rows
+        try:
+            database.update_users(list(rows.values()))
+        except Exception:
+            with self.lock:
+                # Keep the rows for the next attempt unless a newer change is already waiting
+                for user_id, row in rows.items():
+                    record = self.records.get(user_id)
+                    if record is not None:
+                        record.dirty = True
+                    else:
+                        self.pending_rows.setdefault(user_id, row)
+            raise
+        finally:
+            with self.lock:
+                self.flushing_rows = {}
+        return len(rows)
+
+    def __len__(self):
+        return len(self.records)
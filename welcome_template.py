@@ -0,0 +1,68 @@
+import html
+import string
+
+# Placeholders an admin may use in the welcome text
+PLACEHOLDERS = {
+    'user_name': 'منشن اعضای جدید',
+    'group_name': 'نام گروه',
+    'member_count': 'تعداد اعضای گروه',
+    'join_time': 'ساعت ورود',
+}
+
+DEFAULT_WELCOME_TEXT = "خوش آمدید {user_name} به گروه {group_name}!"
+# The column default before templates existed. The text was only shown with welcome media,
+# and members were always mentioned, so stored copies are migrated to DEFAULT_WELCOME_TEXT.
+LEGACY_DEFAULT_WELCOME_TEXT = "خوش آمدید به گروه {group_name}!"
+
+class TemplateError(ValueError):
+    """Raised when a welcome template can't be compiled."""
+
+class CompiledTemplate:
+    """
+    A welcome template parsed once into literal and placeholder parts. Renders to HTML:
+    the admin's literal text is escaped at compile time, and placeholder values must
+    already be HTML.
+    """
+    __slots__ = ('source', 'parts', 'fields')
+
+    def __init__(self, source, parts):
+        self.source = source
+        self.parts = parts # tuple of (escaped literal_text, field_name or None)
+        self.fields = frozenset(field for _, field in parts if field)
+
+    def render(self, values):
+        """Substitutes placeholder values. `values` must contain every name in `fields`."""
+        return "".join(
+            literal + str(values[field]) if field else literal
+            for literal, field in self.parts
+        )
+
+    def __repr__(self):
+        return f"<CompiledTemplate(fields={sorted(self.fields)})>"
+
+def compile_template(text):
+    """Validates and compiles a welcome template. Raises TemplateError on malformed input."""
+    if not text or not text.strip():
+        raise TemplateError("متن خوشامدگویی خالی است.")
+
+    try:
+        parsed = list(string.Formatter().parse(text))
+    except ValueError as e:
+        raise TemplateError(f"ساختار آکولادها در متن نامعتبر است ({e}). برای نوشتن آکولاد از {{{{ و }}}} استفاده کنید.")
+
+    parts = []
+    for literal, field, format_spec, conversion in parsed:
+        literal = html.escape(literal, quote=False) # Sent with parse_mode='HTML'
+        if field is None:
+            parts.append((literal, None))
+            continue
+        if field not in PLACEHOLDERS:
+            allowed = "، ".join(f"{{{name}}}" for name in PLACEHOLDERS)
+            raise TemplateError(f"متغیر ناشناخته {{{field}}}. متغیرهای مجاز: {allowed}")
+        if format_spec or conversion:
+            raise TemplateError(f"قالب‌بندی اضافه برای {{{field}}} پشتیبانی نمی‌شود.")
+        parts.append((literal, field))
+
+    return CompiledTemplate(text, tuple(parts))
+
+DEFAULT_TEMPLATE = compile_template(DEFAULT_WELCOME_TEXT)